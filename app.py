@@ -1,21 +1,229 @@
-from flask import Flask, request, redirect, url_for, render_template, session, abort, send_from_directory
+from flask import (
+    Flask, request, redirect, url_for, render_template, session, abort, g,
+    Response, stream_with_context, jsonify, make_response, has_request_context,
+    before_render_template, template_rendered
+)
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface, session_json_serializer
+from markupsafe import Markup
+from werkzeug.datastructures import CallbackDict
+from werkzeug.security import safe_join, generate_password_hash, check_password_hash
+from werkzeug.utils import send_file
+from werkzeug.serving import make_server, ThreadedWSGIServer
 import sqlite3
+import click
 import os
-from datetime import date
+import re
+import csv
+import io
+import zlib
+import hashlib
+import json
+import secrets
+import mimetypes
+import tempfile
+import signal
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
+
+try:
+    from PIL import Image  # opcional: miniaturas de tickets/CMR
+except ImportError:
+    Image = None
 
 app = Flask(__name__)
-app.secret_key = "CAMBIA_ESTA_CLAVE_LARGA_Y_ALEATORIA"
+app.secret_key = os.environ.get("T360_SECRET_KEY") or "CAMBIA_ESTA_CLAVE_LARGA_Y_ALEATORIA"
 
 DB_PATH = "transporte.db"
 
+# Varias empresas en el mismo host, cada una con su fichero SQLite en EMPRESAS_DIR/<empresa>.db.
+# EMPRESAS_MODO: None (una sola BD, DB_PATH), "subdominio" (<empresa>.EMPRESAS_DOMINIO)
+# o "usuario" (campo "empresa" en el login, guardado en la sesión).
+EMPRESAS_MODO = None
+EMPRESAS_DOMINIO = None
+EMPRESAS_DIR = "empresas"
+EMPRESAS_POOLS_MAX = 64  # pools abiertos a la vez (LRU); cada uno hasta DB_POOL_SIZE conexiones
+_EMPRESA_RE = re.compile(r"^[a-z0-9][a-z0-9-]{0,62}$")
+
+
+# PRAGMAs que se aplican una sola vez al abrir cada conexión del pool
+DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -16000,  # negativo = KiB
+}
+DB_POOL_SIZE = 8
+
+# Segundos que vale la instantánea del usuario guardada en la cookie de sesión (0 = desactivado)
+USER_SNAPSHOT_TTL = 60
+
 
 # -------------------------
 # DB helpers
 # -------------------------
+class ConnectionPool:
+    """
+    Pool de conexiones SQLite reutilizables.
+    Cada request/hilo saca una conexión con acquire() y la devuelve con release().
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, pragmas=None):
+        self.path = path
+        self.size = size
+        self.pragmas = dict(DB_PRAGMAS if pragmas is None else pragmas)
+        self._idle = queue.LifoQueue(maxsize=size)
+        self.closed = False
+
+    def _connect(self):
+        # check_same_thread=False: el pool garantiza que solo un hilo la usa a la vez
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # la usan los triggers de rutas: toda conexión que escriba viajes debe salir del pool
+        conn.create_function("lugar_norm", 1, normalizar_lugar, deterministic=True)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        # las conexiones prestadas en ese momento se cierran al devolverlas
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def empresa_db_path(empresa):
+    return DB_PATH if empresa is None else os.path.join(EMPRESAS_DIR, f"{empresa}.db")
+
+
+class EmpresaPools:
+    """
+    Un ConnectionPool por empresa, abierto la primera vez que se usa (con init_db
+    para aplicar sus migraciones) y cerrado por LRU al pasar de max_open.
+    """
+
+    def __init__(self, max_open=EMPRESAS_POOLS_MAX):
+        self.max_open = max_open
+        self._pools = OrderedDict()
+        self._opening = {}
+        self._lock = threading.Lock()
+
+    def get(self, empresa, crear=False):
+        with self._lock:
+            pool = self._pools.get(empresa)
+            if pool is not None:
+                self._pools.move_to_end(empresa)
+                return pool
+            opening = self._opening.setdefault(empresa, threading.Lock())
+
+        # init_db fuera del lock global: migrar una empresa grande no bloquea a las demás
+        with opening:
+            with self._lock:
+                pool = self._pools.get(empresa)
+            if pool is not None:
+                return pool
+
+            path = empresa_db_path(empresa)
+            if empresa is not None and not crear and not os.path.exists(path):
+                raise LookupError(f"No existe la empresa {empresa!r}.")
+            if empresa is not None:
+                os.makedirs(EMPRESAS_DIR, exist_ok=True)
+            pool = ConnectionPool(path)
+            conn = pool.acquire()
+            try:
+                init_db(conn)
+            finally:
+                pool.release(conn)
+
+            with self._lock:
+                self._pools[empresa] = pool
+                self._opening.pop(empresa, None)
+                while len(self._pools) > self.max_open:
+                    _empresa, evicted = self._pools.popitem(last=False)
+                    evicted.close_all()
+            return pool
+
+    def close_all(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), OrderedDict()
+        for pool in pools:
+            pool.close_all()
+
+
+empresa_pools = EmpresaPools()
+
+
+def empresa_actual():
+    """
+    Empresa del request (o de la variable T360_EMPRESA fuera de request, p. ej. en la CLI).
+    None = la BD única de siempre (DB_PATH).
+    """
+    if "empresa" in g:
+        return g.empresa
+    empresa = None
+    if not has_request_context():
+        empresa = os.environ.get("T360_EMPRESA") or None
+    elif EMPRESAS_MODO == "subdominio" and EMPRESAS_DOMINIO:
+        host = request.host.split(":")[0].lower()
+        if host.endswith("." + EMPRESAS_DOMINIO):
+            empresa = host[:-len(EMPRESAS_DOMINIO) - 1]
+    elif EMPRESAS_MODO == "usuario":
+        empresa = session.get("empresa")
+    if empresa is not None and not _EMPRESA_RE.match(empresa):
+        if has_request_context():
+            abort(404)
+        raise LookupError(f"Nombre de empresa no válido: {empresa!r}")
+    g.empresa = empresa
+    return empresa
+
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Conexión del request actual (una por app context), del pool de su empresa.
+    No hay que cerrarla: se devuelve al pool en el teardown.
+    """
+    if "db" not in g:
+        try:
+            g.db_pool = empresa_pools.get(empresa_actual())
+        except LookupError:
+            if has_request_context():
+                abort(404)
+            raise
+        g.db = TracingConnection(g.db_pool.acquire())
+    return g.db
+
+
+@app.teardown_appcontext
+def release_conn(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.cerrar_medidas()
+        g.pop("db_pool").release(conn.raw)
 
 
 def ensure_column(cur, table, column, definition_sql):
@@ -23,14 +231,83 @@ def ensure_column(cur, table, column, definition_sql):
     Añade columna si no existe. No revienta si ya está.
     definition_sql ejemplo: "tipo TEXT NOT NULL DEFAULT 'gasoil'"
     """
-    cur.execute(f"PRAGMA table_info({table})")
+    # table_xinfo (y no table_info) para ver también las columnas generadas
+    cur.execute(f"PRAGMA table_xinfo({table})")
     cols = [r["name"] for r in cur.fetchall()]
     if column not in cols:
         cur.execute(f"ALTER TABLE {table} ADD COLUMN {definition_sql}")
+        return True
+    return False
 
 
-def init_db():
-    conn = get_conn()
+def month_range(mes):
+    """
+    "2025-12" -> ("2025-12", "2026-01").
+    Para filtrar con fecha >= ? AND fecha < ? en vez de substr(fecha,1,7)=?,
+    que no puede usar índices.
+    """
+    y, m = int(mes[:4]), int(mes[5:7])
+    y2, m2 = (y + 1, 1) if m == 12 else (y, m + 1)
+    return f"{y:04d}-{m:02d}", f"{y2:04d}-{m2:02d}"
+
+
+# tabla -> (columna de fecha, columnas por las que se filtra)
+INDEXED_TABLES = {
+    "viajes": ("fecha", ["camion_id", "conductor_id"]),
+    "repostajes": ("fecha", ["camion_id", "conductor_id"]),
+    "tacografo": ("fecha", ["conductor_id"]),
+}
+
+
+def init_indexes(cur):
+    """
+    Índices por fecha y (camión|conductor, fecha). Los filtros por mes usan el de fecha
+    con month_range(); los agregados mensuales salen de kpi_mensual.
+    """
+    for table, (fecha_col, fk_cols) in INDEXED_TABLES.items():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{fecha_col} ON {table}({fecha_col})")
+        for col in fk_cols:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{col} ON {table}({col}, {fecha_col})")
+
+
+def month_query_plans(cur, mes="2025-01"):
+    """EXPLAIN QUERY PLAN de los filtros por mes: (tabla, sql, detalle del plan)."""
+    desde, hasta = month_range(mes)
+    out = []
+    for table, (fecha_col, fk_cols) in INDEXED_TABLES.items():
+        queries = [(f"SELECT * FROM {table} WHERE {fecha_col} >= ? AND {fecha_col} < ?", (desde, hasta))]
+        queries += [
+            (f"SELECT * FROM {table} WHERE {col} = ? AND {fecha_col} >= ? AND {fecha_col} < ?", (1, desde, hasta))
+            for col in fk_cols
+        ]
+        for sql, params in queries:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            out.append((table, sql, " / ".join(r["detail"] for r in cur.fetchall())))
+    return out
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Falla si algún filtro por mes acaba en SCAN completo."""
+    bad = 0
+    for table, sql, detail in month_query_plans(get_conn().cursor()):
+        ok = "USING INDEX" in detail or "USING COVERING INDEX" in detail
+        bad += 0 if ok else 1
+        click.echo(("OK   " if ok else "SCAN ") + sql + "\n     " + detail)
+    if bad:
+        raise SystemExit(1)
+
+
+# -------------------------
+# Migraciones de esquema
+# -------------------------
+# Cada migración se aplica una vez, en orden, dentro de una transacción, y queda
+# anotada en schema_version. Al arrancar solo se compara MAX(version) con la última.
+MIGRATION_BATCH = 20000
+
+
+def _mig_001_tablas_base(conn):
+    """Tablas base. Los ensure_column cubren las BDs anteriores a schema_version."""
     cur = conn.cursor()
 
     cur.execute("""
@@ -42,6 +319,8 @@ def init_db():
       active INTEGER NOT NULL DEFAULT 1
     )
     """)
+    # chófer vinculado a un conductor (como en la versión extendida)
+    ensure_column(cur, "users", "conductor_id", "conductor_id INTEGER")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS viajes (
@@ -55,6 +334,17 @@ def init_db():
     )
     """)
 
+    # columnas de viajes para costes/KPIs (como en la versión extendida)
+    ensure_column(cur, "viajes", "tipo_tramo", "tipo_tramo TEXT NOT NULL DEFAULT 'CARGADO'")
+    ensure_column(cur, "viajes", "ingreso", "ingreso REAL NOT NULL DEFAULT 0")
+    ensure_column(cur, "viajes", "peajes", "peajes REAL NOT NULL DEFAULT 0")
+    ensure_column(cur, "viajes", "parking", "parking REAL NOT NULL DEFAULT 0")
+    ensure_column(cur, "viajes", "camion_id", "camion_id INTEGER")
+    ensure_column(cur, "viajes", "conductor_id", "conductor_id INTEGER")
+    ensure_column(cur, "viajes", "duracion_h", "duracion_h REAL")
+    # distancia de los viajes sin odómetro (importados)
+    ensure_column(cur, "viajes", "distancia_km", "distancia_km REAL")
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS repostajes (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -71,6 +361,9 @@ def init_db():
     ensure_column(cur, "repostajes", "tipo", "tipo TEXT NOT NULL DEFAULT 'gasoil'")
     ensure_column(cur, "repostajes", "conductor_id", "conductor_id INTEGER")
     ensure_column(cur, "repostajes", "ticket_path", "ticket_path TEXT")
+    ensure_column(cur, "repostajes", "camion_id", "camion_id INTEGER")
+    # depósito lleno: necesario para el consumo lleno-a-lleno
+    ensure_column(cur, "repostajes", "lleno", "lleno INTEGER NOT NULL DEFAULT 1")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS tacografo (
@@ -82,6 +375,26 @@ def init_db():
       comentario TEXT
     )
     """)
+    ensure_column(cur, "tacografo", "conductor_id", "conductor_id INTEGER")
+    # origen='reloj': fila diaria que acumulan las sesiones start/stop (una por conductor y día)
+    ensure_column(cur, "tacografo", "origen", "origen TEXT NOT NULL DEFAULT 'manual'")
+    cur.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_tacografo_reloj
+    ON tacografo(conductor_id, fecha) WHERE origen='reloj'
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tacografo_sesiones (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      conductor_id INTEGER NOT NULL,
+      actividad TEXT NOT NULL CHECK(actividad IN ('conduccion','disponibilidad','descanso')),
+      inicio TEXT NOT NULL,
+      fin TEXT,
+      pausada INTEGER NOT NULL DEFAULT 0,
+      created_by_user_id INTEGER
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tacografo_sesiones_conductor ON tacografo_sesiones(conductor_id, id)")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS camiones (
@@ -100,7 +413,40 @@ def init_db():
     )
     """)
 
-    conn.commit()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL
+    )
+    """)
+    cur.executemany(
+        "INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)",
+        [(k, str(d)) for k, (d, _label) in SETTINGS_DEFAULTS.items()] + [(SETTINGS_VERSION_KEY, "1")]
+    )
+
+    # claves de idempotencia de la API por lotes
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS idempotencia (
+      tabla TEXT NOT NULL,
+      clave TEXT NOT NULL,
+      registro_id INTEGER NOT NULL,
+      creado TEXT NOT NULL DEFAULT (datetime('now')),
+      PRIMARY KEY (tabla, clave)
+    ) WITHOUT ROWID
+    """)
+
+    # ficheros subidos (tickets/CMR), direccionados por contenido
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS uploads (
+      hash TEXT PRIMARY KEY,
+      path TEXT NOT NULL UNIQUE,
+      size INTEGER NOT NULL,
+      mime TEXT,
+      nombre_original TEXT,
+      thumb_path TEXT,
+      creado TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """)
 
     # usuarios demo
     cur.execute("SELECT 1 FROM users WHERE username='Admin'")
@@ -111,359 +457,3310 @@ def init_db():
     if not cur.fetchone():
         cur.execute("INSERT INTO users(username,pin,role,active) VALUES(?,?,?,1)", ("Mohsin", "1111", "driver"))
 
-    conn.commit()
-    conn.close()
 
+def _mig_002_esquema_extendido(conn):
+    """
+    BDs creadas por la versión extendida: viajes con fecha_salida/fecha_llegada
+    (sin fecha), repostajes con ticket_path NOT NULL y tacografo con conductor_id
+    NOT NULL y UNIQUE(conductor_id, fecha). Se reconstruyen por lotes conservando
+    cmr_path y created_by_user_id.
+    """
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(viajes)")
+    cols = {r["name"] for r in cur.fetchall()}
+    if "fecha_salida" in cols and "fecha" not in cols:
+        rebuild_table_batched(conn, "viajes", """
+          CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            origen TEXT NOT NULL,
+            destino TEXT NOT NULL,
+            km_inicio REAL NOT NULL DEFAULT 0,
+            km_fin REAL NOT NULL DEFAULT 0,
+            peso_kg REAL NOT NULL DEFAULT 0,
+            tipo_tramo TEXT NOT NULL DEFAULT 'CARGADO',
+            ingreso REAL NOT NULL DEFAULT 0,
+            peajes REAL NOT NULL DEFAULT 0,
+            parking REAL NOT NULL DEFAULT 0,
+            camion_id INTEGER,
+            conductor_id INTEGER,
+            duracion_h REAL,
+            cmr_path TEXT,
+            created_by_user_id INTEGER,
+            distancia_km REAL
+          )
+        """, """
+          SELECT o.id, o.fecha_salida, o.origen, o.destino, o.km_inicio, o.km_fin, o.peso_kg,
+                 o.tipo_tramo, o.ingreso, o.peajes, o.parking, o.camion_id, o.conductor_id,
+                 CASE WHEN julianday(o.fecha_llegada) > julianday(o.fecha_salida)
+                      THEN ROUND((julianday(o.fecha_llegada) - julianday(o.fecha_salida)) * 24, 2) END,
+                 o.cmr_path, o.created_by_user_id, NULL
+          FROM viajes o
+        """)
 
-# -------------------------
-# Auth helpers
-# -------------------------
-def current_user():
-    uid = session.get("user_id")
-    if not uid:
-        return None
-    conn = get_conn()
+    cur.execute("PRAGMA table_info(repostajes)")
+    ticket = [r for r in cur.fetchall() if r["name"] == "ticket_path"]
+    if ticket and ticket[0]["notnull"]:
+        rebuild_table_batched(conn, "repostajes", """
+          CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            litros REAL NOT NULL DEFAULT 0,
+            precio_litro REAL NOT NULL DEFAULT 0,
+            importe REAL NOT NULL DEFAULT 0,
+            km_odometro REAL,
+            estacion TEXT,
+            tipo TEXT NOT NULL DEFAULT 'gasoil',
+            conductor_id INTEGER,
+            ticket_path TEXT,
+            camion_id INTEGER,
+            lleno INTEGER NOT NULL DEFAULT 1,
+            created_by_user_id INTEGER
+          )
+        """, """
+          SELECT o.id, o.fecha, o.litros, o.precio_litro, o.importe, o.km_odometro, o.estacion,
+                 o.tipo, o.conductor_id, NULLIF(o.ticket_path, ''), o.camion_id, o.lleno,
+                 o.created_by_user_id
+          FROM repostajes o
+        """)
+
+    cur.execute("PRAGMA table_info(tacografo)")
+    conductor = [r for r in cur.fetchall() if r["name"] == "conductor_id"]
+    if conductor and conductor[0]["notnull"]:
+        # filas manuales sin conductor y varias filas (manual + reloj) por conductor y día
+        rebuild_table_batched(conn, "tacografo", """
+          CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            horas_conduccion REAL NOT NULL DEFAULT 0,
+            horas_disponibilidad REAL NOT NULL DEFAULT 0,
+            horas_descanso REAL NOT NULL DEFAULT 11,
+            comentario TEXT,
+            conductor_id INTEGER,
+            origen TEXT NOT NULL DEFAULT 'manual',
+            created_by_user_id INTEGER
+          )
+        """, """
+          SELECT o.id, o.fecha, o.horas_conduccion, o.horas_disponibilidad, o.horas_descanso,
+                 o.comentario, o.conductor_id, o.origen, o.created_by_user_id
+          FROM tacografo o
+        """)
+        # el índice lo creó _mig_001_tablas_base y se pierde con el DROP
+        conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_tacografo_reloj
+        ON tacografo(conductor_id, fecha) WHERE origen='reloj'
+        """)
+
+
+def _mig_003_derivados(conn):
+    """Índices, agregados mantenidos por triggers y cachés derivadas."""
     cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id=? AND active=1", (uid,))
-    u = cur.fetchone()
-    conn.close()
-    return u
+    init_indexes(cur)
+    init_kpi_mensual(cur)
+    init_camion_estado(cur)
+    init_tacografo_semana(cur)
+    init_consumo(cur)
+    init_rentabilidad(cur)
+    init_rutas(cur)
+    init_tabla_version(cur)
 
 
-def login_required(fn):
-    def wrapper(*args, **kwargs):
-        if not current_user():
-            return redirect(url_for("login"))
-        return fn(*args, **kwargs)
-    wrapper.__name__ = fn.__name__
-    return wrapper
+def _mig_004_pin_hash(conn):
+    """PINs con hash (PIN_HASH_METHOD) en users.pin_hash; users.pin queda vacío."""
+    cur = conn.cursor()
+    ensure_column(cur, "users", "pin_hash", "pin_hash TEXT")
+    cur.execute("SELECT id, pin FROM users WHERE pin_hash IS NULL AND pin != ''")
+    cur.executemany(
+        "UPDATE users SET pin_hash=?, pin='' WHERE id=?",
+        [(hash_pin(r["pin"]), r["id"]) for r in cur.fetchall()]
+    )
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS login_bloqueos (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ts TEXT NOT NULL DEFAULT (datetime('now')),
+      clave TEXT NOT NULL,
+      username TEXT,
+      ip TEXT
+    )
+    """)
 
 
-def manager_required(fn):
-    def wrapper(*args, **kwargs):
-        u = current_user()
-        if not u:
-            return redirect(url_for("login"))
-        if u["role"] != "manager":
-            return abort(403)
-        return fn(*args, **kwargs)
-    wrapper.__name__ = fn.__name__
-    return wrapper
+def _mig_005_descanso_reloj(conn):
+    """Triggers de tacografo_semana que ignoran el descanso no registrado del reloj, y recálculo."""
+    cur = conn.cursor()
+    init_tacografo_semana(cur)
+    rebuild_tacografo_semana(cur)
 
 
-# -------------------------
-# Login / Logout
-# -------------------------
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    error = ""
-    if request.method == "POST":
-        username = (request.form.get("username") or "").strip()
-        pin = (request.form.get("pin") or "").strip()
+def _mig_006_viajes_sin_odometro(conn):
+    """
+    viajes.km_inicio/km_fin admiten NULL (viajes importados sin odómetro) y la distancia
+    de esos viajes va en distancia_km. Reconstruye viajes y vuelve a crear sus índices y
+    triggers (ya con _KM_VIAJE_SQL).
+    """
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_xinfo(viajes)")
+    cols = {r["name"]: r for r in cur.fetchall()}
+    if cols["km_inicio"]["notnull"]:
+        opcionales = ", ".join(
+            f"o.{c}" if c in cols else "NULL" for c in ("ruta_id", "cmr_path", "created_by_user_id", "distancia_km")
+        )
+        rebuild_table_batched(conn, "viajes", """
+          CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT NOT NULL,
+            origen TEXT NOT NULL,
+            destino TEXT NOT NULL,
+            km_inicio REAL,
+            km_fin REAL,
+            peso_kg REAL NOT NULL DEFAULT 0,
+            tipo_tramo TEXT NOT NULL DEFAULT 'CARGADO',
+            ingreso REAL NOT NULL DEFAULT 0,
+            peajes REAL NOT NULL DEFAULT 0,
+            parking REAL NOT NULL DEFAULT 0,
+            camion_id INTEGER,
+            conductor_id INTEGER,
+            duracion_h REAL,
+            ruta_id INTEGER,
+            cmr_path TEXT,
+            created_by_user_id INTEGER,
+            distancia_km REAL
+          )
+        """, f"""
+          SELECT o.id, o.fecha, o.origen, o.destino, o.km_inicio, o.km_fin, o.peso_kg,
+                 o.tipo_tramo, o.ingreso, o.peajes, o.parking, o.camion_id, o.conductor_id,
+                 o.duracion_h, {opcionales}
+          FROM viajes o
+        """)
+        _mig_003_derivados(conn)
 
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE username=? AND pin=? AND active=1", (username, pin))
-        u = cur.fetchone()
-        conn.close()
 
-        if u:
-            session["user_id"] = u["id"]
-            return redirect(url_for("dashboard"))
-        error = "Usuario o PIN incorrecto."
+def _mig_007_estado_ultimo_viaje(conn):
+    """camion_estado con el último viaje por (fecha, km_fin) y no por orden de alta."""
+    cur = conn.cursor()
+    init_camion_estado(cur)
+    rebuild_camion_estado(cur)
 
-    return render_template(
-        "pages/login.html",
-        hide_layout=True,
-        body_class="login-v2",
-        error=error
-    )
 
+def _mig_008_sin_columna_mes(conn):
+    """
+    Quita la columna generada `mes` y su índice: ninguna consulta filtra por ella y el
+    índice solo costaba en cada escritura. Con SQLite < 3.35 (sin DROP COLUMN) se queda
+    la columna, que es VIRTUAL y sin índice no cuesta nada.
+    """
+    cur = conn.cursor()
+    for table in INDEXED_TABLES:
+        cur.execute(f"DROP INDEX IF EXISTS idx_{table}_mes")
+        cur.execute(f"PRAGMA table_xinfo({table})")
+        if "mes" in {r["name"] for r in cur.fetchall()} and sqlite3.sqlite_version_info >= (3, 35, 0):
+            cur.execute(f"ALTER TABLE {table} DROP COLUMN mes")
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect(url_for("login"))
 
+def _mig_009_triggers_viajes(conn):
+    """
+    Triggers de viajes sin lugar_norm (ruta_id se asigna en Python) y AFTER UPDATE OF
+    solo con las columnas que usa cada agregado.
+    """
+    cur = conn.cursor()
+    init_kpi_mensual(cur)
+    init_camion_estado(cur)
+    init_rentabilidad(cur)
+    init_rutas(cur)
+    asignar_rutas_pendientes(cur)
 
-# -------------------------
-# Dashboard
-# -------------------------
-@app.route("/")
-@login_required
-def index():
-    return redirect(url_for("dashboard"))
 
+def _mig_010_una_sesion_abierta(conn):
+    """
+    Como mucho una sesión de reloj abierta por conductor (índice único parcial). Las
+    abiertas de más que pudiera haber se cierran en su propio inicio, sin sumar horas.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+      UPDATE tacografo_sesiones SET fin=inicio
+      WHERE fin IS NULL AND id NOT IN (
+        SELECT MAX(id) FROM tacografo_sesiones WHERE fin IS NULL GROUP BY conductor_id
+      )
+    """)
+    cur.execute("""
+      CREATE UNIQUE INDEX IF NOT EXISTS ux_tacografo_sesiones_abierta
+      ON tacografo_sesiones(conductor_id) WHERE fin IS NULL
+    """)
 
-@app.route("/dashboard")
-@login_required
-def dashboard():
-    u = current_user()
 
-    conn = get_conn()
+def _mig_011_descanso_semanal(conn):
+    """tacografo_semana con los días libres y el descanso de cada día, para el descanso semanal."""
     cur = conn.cursor()
+    init_tacografo_semana(cur)
+    rebuild_tacografo_semana(cur)
 
-    cur.execute("SELECT COUNT(*) AS n FROM viajes")
-    total_viajes = int(cur.fetchone()["n"])
 
-    cur.execute("SELECT IFNULL(SUM(km_fin-km_inicio),0) AS km FROM viajes")
-    km_total = float(cur.fetchone()["km"] or 0)
+def _mig_012_consumo_pendiente(conn):
+    """
+    Triggers de UPDATE/DELETE en repostajes que apuntan el camión en consumo_pendiente.
+    Los tramos de ediciones anteriores pueden estar desfasados: se recalculan todos los camiones.
+    """
+    cur = conn.cursor()
+    init_consumo(cur)
+    cur.execute("""
+      INSERT OR REPLACE INTO consumo_pendiente(camion_id, desde_km)
+      SELECT DISTINCT camion_id, -1 FROM repostajes WHERE camion_id IS NOT NULL
+    """)
 
-    cur.execute("SELECT IFNULL(SUM(importe),0) AS total FROM repostajes")
-    repostajes_total = float(cur.fetchone()["total"] or 0)
 
-    cur.execute("SELECT IFNULL(SUM(horas_conduccion),0) AS h FROM tacografo")
-    horas = float(cur.fetchone()["h"] or 0)
+# (versión, nombre, función(conn)); solo se añaden al final, nunca se renumeran
+MIGRATIONS = [
+    (1, "tablas base", _mig_001_tablas_base),
+    (2, "esquema de la versión extendida", _mig_002_esquema_extendido),
+    (3, "índices y agregados", _mig_003_derivados),
+    (4, "PINs con hash", _mig_004_pin_hash),
+    (5, "descanso no registrado del reloj", _mig_005_descanso_reloj),
+    (6, "viajes sin odómetro", _mig_006_viajes_sin_odometro),
+    (7, "último viaje por fecha en camion_estado", _mig_007_estado_ultimo_viaje),
+    (8, "sin columna mes", _mig_008_sin_columna_mes),
+    (9, "triggers de viajes sin funciones de la app", _mig_009_triggers_viajes),
+    (10, "una sesión de reloj abierta por conductor", _mig_010_una_sesion_abierta),
+    (11, "descanso semanal en tacografo_semana", _mig_011_descanso_semanal),
+    (12, "consumo recalculado al editar o borrar repostajes", _mig_012_consumo_pendiente),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-    conn.close()
 
-    return render_template(
-        "pages/dashboard.html",
-        user=u,
-        active_page="dashboard",
-        page_title="Panel de Gestión",
-        page_subtitle=f"Resumen general · {date.today().isoformat()}",
-        total_viajes=total_viajes,
-        km_total=km_total,
-        gasoil_total=repostajes_total,
-        horas_conduccion=horas,
-    )
+def rebuild_table_batched(conn, table, create_sql, select_sql, batch=MIGRATION_BATCH):
+    """
+    Reconstruye una tabla (cambios que ALTER TABLE no admite) sin una única transacción
+    gigante: crea {table}__new, copia por lotes de id confirmando cada lote (si se corta,
+    la siguiente ejecución sigue desde el último id copiado) y termina con el resto,
+    DROP de la vieja y RENAME, dejando abierta esa última transacción para migrate().
+    select_sql lee de la tabla vieja con alias "o" y sin WHERE.
+    Los índices y triggers de la tabla se pierden con el DROP: los recrea _mig_003_derivados
+    (una migración posterior que reconstruya tablas debe volver a llamar a los init_*).
+    """
+    nueva = f"{table}__new"
+    conn.execute(create_sql.format(table=nueva))
+    copiar = f"INSERT INTO {nueva} {select_sql} WHERE o.id > ? ORDER BY o.id"
+    if conn.in_transaction:
+        conn.commit()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        desde = conn.execute(f"SELECT IFNULL(MAX(id), 0) FROM {nueva}").fetchone()[0]
+        n = conn.execute(copiar + " LIMIT ?", (desde, batch)).rowcount
+        conn.commit()
+        if n < batch:
+            break
 
+    conn.execute("BEGIN IMMEDIATE")
+    desde = conn.execute(f"SELECT IFNULL(MAX(id), 0) FROM {nueva}").fetchone()[0]
+    conn.execute(copiar, (desde,))
+    conn.execute(f"DROP TABLE {table}")
+    # sin esto, RENAME valida triggers de otras tablas que aún apuntan a la tabla borrada
+    conn.execute("PRAGMA legacy_alter_table=ON")
+    conn.execute(f"ALTER TABLE {nueva} RENAME TO {table}")
+    conn.execute("PRAGMA legacy_alter_table=OFF")
 
-# -------------------------
-# Serve uploads (CMR / tickets)
-# -------------------------
-@app.route("/uploads/<path:subpath>")
-@login_required
-def serve_upload(subpath):
-    subpath = (subpath or "").replace("..", "").lstrip("/").lstrip("\\")
-    return send_from_directory("uploads", subpath, as_attachment=False)
 
+def schema_version(conn):
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] or 0
 
-# -------------------------
-# Viajes
-# -------------------------
-@app.route("/viajes", methods=["GET", "POST"])
-@login_required
-def viajes():
-    u = current_user()
-    error = ""
 
-    if request.method == "POST":
-        fecha = (request.form.get("fecha") or "").strip()
-        origen = (request.form.get("origen") or "").strip()
-        destino = (request.form.get("destino") or "").strip()
+def migrate(conn, log=None):
+    """Aplica las migraciones pendientes. Devuelve las versiones aplicadas."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+      version INTEGER PRIMARY KEY,
+      nombre TEXT NOT NULL,
+      aplicada TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """)
+    conn.commit()
 
-        def fnum(x, default=0.0):
-            try:
-                return float(x) if x not in (None, "") else float(default)
-            except:
-                return float(default)
-
-        km_inicio = fnum(request.form.get("km_inicio"), 0)
-        km_fin = fnum(request.form.get("km_fin"), 0)
-        peso_kg = fnum(request.form.get("peso_kg"), 0)
-
-        if not fecha or not origen or not destino:
-            error = "Falta fecha/origen/destino."
-        elif km_fin < km_inicio:
-            error = "km_fin no puede ser menor que km_inicio."
-        else:
-            conn = get_conn()
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO viajes(fecha,origen,destino,km_inicio,km_fin,peso_kg) VALUES(?,?,?,?,?,?)",
-                (fecha, origen, destino, km_inicio, km_fin, peso_kg)
-            )
+    aplicadas = []
+    for version, nombre, fn in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        # otro proceso puede haberla aplicado mientras esperábamos el lock
+        if version <= schema_version(conn):
+            conn.rollback()
+            continue
+        if log:
+            log(f"migración {version}: {nombre}")
+        try:
+            fn(conn)
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO schema_version(version, nombre) VALUES(?,?)", (version, nombre))
             conn.commit()
-            conn.close()
-            return redirect(url_for("viajes"))
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(version)
+    return aplicadas
+
+
+def init_db(conn=None):
+    """Al arrancar: una sola consulta si el esquema ya está al día."""
+    conn = conn if conn is not None else get_conn()
+    if schema_version(conn) < SCHEMA_VERSION:
+        migrate(conn)
 
+
+@app.cli.command("migrar")
+def migrar_command():
+    """Aplica las migraciones pendientes de la BD (T360_EMPRESA para otra empresa)."""
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      SELECT
-        v.*,
-        (v.km_fin - v.km_inicio) AS km_total
-      FROM viajes v
-      ORDER BY v.id DESC
-      LIMIT 200
-    """)
-    rows = cur.fetchall()
-    conn.close()
+    antes = schema_version(conn)
+    aplicadas = migrate(conn, log=click.echo)
+    click.echo(f"esquema: {antes} → {schema_version(conn)} ({len(aplicadas)} migraciones)")
 
-    return render_template(
-        "pages/viajes.html",
-        user=u,
-        active_page="viajes",
-        page_title="Viajes",
-        page_subtitle="Registro operativo",
-        rows=rows,
-        error=error
-    )
+
+def to_int_or_none(x):
+    try:
+        return int(x) if x not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
 
 
 # -------------------------
-# Repostajes
+# Listados (paginación keyset)
 # -------------------------
-@app.route("/repostajes", methods=["GET", "POST"])
-@login_required
-def repostajes():
-    u = current_user()
-    error = ""
+PAGE_SIZE = 50
+PAGE_SIZE_MAX = 500
 
-    def fnum(x, default=0.0):
-        try:
-            return float(x) if x not in (None, "") else float(default)
-        except:
-            return float(default)
 
-    if request.method == "POST":
-        fecha = (request.form.get("fecha") or "").strip()
-        estacion = (request.form.get("estacion") or "").strip()
+def fetch_page(cur, select_sql, alias, fecha_col=None, fk_cols=()):
+    """
+    Página de un listado ordenado por id DESC usando keyset (?before=<id>),
+    no OFFSET: el coste es el mismo en la página 1 que en la 10.000.
+    Filtros en SQL desde la query string: ?desde, ?hasta (sobre fecha_col),
+    ?<fk> para cada columna de fk_cols, y ?limit (tamaño de página).
+    Devuelve (rows, pager) con pager["next_url"] para la página siguiente o None.
+    """
+    args = request.args
+    limit = to_int_or_none(args.get("limit")) or PAGE_SIZE
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
 
-        tipo = (request.form.get("tipo") or "gasoil").strip().lower()
-        if tipo not in ("gasoil", "adblue"):
-            tipo = "gasoil"
+    where, params = [], []
+    before = to_int_or_none(args.get("before"))
+    if before is not None:
+        where.append(f"{alias}.id < ?")
+        params.append(before)
 
-        conductor_id_raw = (request.form.get("conductor_id") or "").strip()
-        conductor_id = None
-        if conductor_id_raw:
-            try:
-                conductor_id = int(conductor_id_raw)
-            except:
-                conductor_id = None
+    filtros = {}
+    if fecha_col:
+        desde = (args.get("desde") or "").strip()
+        hasta = (args.get("hasta") or "").strip()
+        if desde:
+            where.append(f"{alias}.{fecha_col} >= ?")
+            params.append(desde)
+            filtros["desde"] = desde
+        if hasta:
+            # hasta inclusivo: fecha < día siguiente (sirve también con fecha+hora)
+            where.append(f"{alias}.{fecha_col} < date(?, '+1 day')")
+            params.append(hasta)
+            filtros["hasta"] = hasta
+    for col in fk_cols:
+        val = to_int_or_none(args.get(col))
+        if val is not None:
+            where.append(f"{alias}.{col} = ?")
+            params.append(val)
+            filtros[col] = val
 
-        litros = fnum(request.form.get("litros"), 0)
-        precio_litro = fnum(request.form.get("precio_litro"), 0)
+    sql = select_sql
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {alias}.id DESC LIMIT ?"
+    cur.execute(sql, params + [limit + 1])
+    rows = cur.fetchall()
 
-        importe_raw = request.form.get("importe")
-        km_odometro_raw = request.form.get("km_odometro")
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_url = url_for(request.endpoint, before=rows[-1]["id"], limit=limit, **filtros)
 
-        importe_val = fnum(importe_raw, litros * precio_litro)
+    first_url = url_for(request.endpoint, limit=limit, **filtros) if before is not None else None
+    return rows, {"next_url": next_url, "first_url": first_url, "limit": limit, "filtros": filtros}
 
-        km_odo_val = None
-        if km_odometro_raw not in (None, ""):
-            try:
-                km_odo_val = float(km_odometro_raw)
-            except:
-                km_odo_val = None
-
-        # ticket upload (opcional)
-        ticket_path = None
-        ticket_file = request.files.get("ticket_file")
-        if ticket_file and ticket_file.filename:
-            os.makedirs("uploads", exist_ok=True)
-            safe_name = ticket_file.filename.replace("/", "_").replace("\\", "_")
-            saved_name = f"ticket_{date.today().isoformat()}_{safe_name}"
-            full_path = os.path.join("uploads", saved_name)
-            ticket_file.save(full_path)
-            ticket_path = saved_name
-
-        if not fecha:
-            error = "Falta la fecha."
-        elif litros <= 0:
-            error = "Litros debe ser mayor que 0."
-        elif precio_litro <= 0:
-            error = "Precio/L debe ser mayor que 0."
-        elif importe_val <= 0:
-            error = "Importe debe ser mayor que 0."
-        else:
-            conn = get_conn()
-            cur = conn.cursor()
-            cur.execute(
-                """
-                INSERT INTO repostajes(fecha, litros, precio_litro, importe, km_odometro, estacion, tipo, conductor_id, ticket_path)
-                VALUES(?,?,?,?,?,?,?,?,?)
-                """,
-                (fecha, litros, precio_litro, importe_val, km_odo_val, estacion, tipo, conductor_id, ticket_path)
-            )
-            conn.commit()
-            conn.close()
-            return redirect(url_for("repostajes"))
 
-    conn = get_conn()
-    cur = conn.cursor()
+# -------------------------
+# Caché de render de listados
+# -------------------------
+# Tablas con contador de versión (lo suben triggers en cada INSERT/UPDATE/DELETE,
+# también los que vienen de imports, CLI u otros procesos).
+VERSIONED_TABLES = (
+    "viajes", "repostajes", "tacografo", "camiones", "conductores", "camion_estado", "users", "uploads", "settings",
+)
+RENDER_CACHE_MAX_ENTRIES = 256
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
 
-    # select chofer
-    cur.execute("SELECT id, username FROM users WHERE active=1 ORDER BY username")
-    conductores = cur.fetchall()
 
-    # tabla
+def init_tabla_version(cur):
     cur.execute("""
-      SELECT
-        r.*,
-        CASE WHEN r.litros > 0 THEN (r.importe / r.litros) ELSE 0 END AS precio_calc
-      FROM repostajes r
-      ORDER BY r.id DESC
-      LIMIT 200
+    CREATE TABLE IF NOT EXISTS tabla_version (
+      tabla TEXT PRIMARY KEY,
+      version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
     """)
-    rows = cur.fetchall()
-    conn.close()
+    ensure_column(cur, "tabla_version", "modificado", "modificado TEXT")
+    for table in VERSIONED_TABLES:
+        for ev in ("INSERT", "UPDATE", "DELETE"):
+            name = f"trg_{table}_version_{ev[:3].lower()}"
+            # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+            cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cur.execute(f"""
+            CREATE TRIGGER {name} AFTER {ev} ON {table} BEGIN
+              INSERT INTO tabla_version(tabla, version, modificado) VALUES('{table}', 1, CURRENT_TIMESTAMP)
+              ON CONFLICT(tabla) DO UPDATE SET version=version+1, modificado=CURRENT_TIMESTAMP;
+            END
+            """)
 
-    return render_template(
-        "pages/repostajes.html",
+
+def _tabla_estado():
+    """{tabla: (version, modificado)}; una sola consulta por request (se guarda en g)."""
+    if "tabla_estado" not in g:
+        cur = get_conn().cursor()
+        cur.execute("SELECT tabla, version, modificado FROM tabla_version")
+        g.tabla_estado = {r["tabla"]: (r["version"], r["modificado"]) for r in cur.fetchall()}
+    return g.tabla_estado
+
+
+def tabla_versiones(tablas):
+    estado = _tabla_estado()
+    return tuple(estado.get(t, (0, None))[0] for t in tablas)
+
+
+def tablas_modificado(tablas):
+    """Último cambio (datetime UTC) entre esas tablas, o None si nunca se han tocado."""
+    stamps = [_tabla_estado().get(t, (0, None))[1] for t in tablas]
+    stamps = [st for st in stamps if st]
+    if not stamps:
+        return None
+    return datetime.fromisoformat(max(stamps)).replace(tzinfo=timezone.utc)
+
+
+class RenderCache:
+    """LRU de HTML renderizado, acotado por nº de entradas y por tamaño total (bytes UTF-8)."""
+
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # clave -> (html, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, html):
+        # len(html) cuenta caracteres: con tildes y símbolos (€, →) los bytes son más
+        size = len(html.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (html, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _k, (_html, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
+render_cache = RenderCache()
+
+
+def render_listado(template, tablas, layout, build):
+    """
+    Renderiza una página de listado cacheando solo su bloque "content".
+    layout: variables del layout (user, títulos), baratas; build(): consultas del listado.
+    Clave: (plantilla, query string, rol, versiones de las tablas que lee la página);
+    un alta en cualquiera de esas tablas cambia la clave y la entrada vieja acaba
+    saliendo por LRU. Los POST (formulario con error) no se cachean.
+    """
+    if request.method != "GET":
+        return render_template(template, **layout, **build())
+
+    u = layout.get("user")
+    key = (
+        empresa_actual(),
+        template,
+        tuple(sorted(request.args.items(multi=True))),
+        u["role"] if u else None,
+        tabla_versiones(tablas),
+    )
+    html = render_cache.get(key)
+    if html is None:
+        ctx = {**layout, **build()}
+        app.update_template_context(ctx)
+        tmpl = app.jinja_env.get_template(template)
+        t0 = time.perf_counter()
+        html = Markup("".join(tmpl.blocks["content"](tmpl.new_context(ctx))))
+        metricas.plantilla(f"{template}#content", time.perf_counter() - t0)
+        render_cache.put(key, html)
+    return render_template(template, cached_content=html, **layout)
+
+
+def _version_app():
+    """
+    Huella del contenido de app.py y las plantillas, y su última modificación (UTC).
+    Se calcula una vez al importar: tras un despliegue cambia el validador de las
+    páginas aunque los datos sean los mismos.
+    """
+    ficheros = [os.path.abspath(__file__)]
+    for carpeta, _, nombres in os.walk(os.path.join(app.root_path, app.template_folder)):
+        ficheros += [os.path.join(carpeta, n) for n in nombres]
+    h = hashlib.sha1()
+    mtime = 0.0
+    for f in sorted(ficheros):
+        with open(f, "rb") as fh:
+            h.update(os.path.relpath(f, app.root_path).encode())
+            h.update(fh.read())
+        mtime = max(mtime, os.path.getmtime(f))
+    return h.hexdigest()[:16], datetime.fromtimestamp(int(mtime), timezone.utc)
+
+
+APP_VERSION, APP_MODIFICADO = _version_app()
+
+
+def conditional_get(*tablas):
+    """
+    Decorador para páginas GET: calcula un validador con las versiones de las tablas
+    que lee la página (más usuario, query string, día y versión de la app, que también
+    cambian lo que se pinta) y responde 304 sin consultar ni renderizar si el cliente
+    ya tiene esa versión. Va debajo de login_required.
+    """
+    def deco(fn):
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return fn(*args, **kwargs)
+
+            u = current_user()
+            etag = hashlib.sha1(repr((
+                empresa_actual(),
+                request.endpoint,
+                sorted(request.args.items(multi=True)),
+                u["id"] if u else None,
+                u["role"] if u else None,
+                date.today().isoformat(),
+                APP_VERSION,
+                tabla_versiones(tablas),
+            )).encode()).hexdigest()
+            modificado = tablas_modificado(tablas)
+            if modificado:
+                modificado = max(modificado, APP_MODIFICADO)
+
+            # If-None-Match manda; If-Modified-Since solo si el cliente no envía ETag
+            if request.if_none_match:
+                fresco = etag in request.if_none_match
+            else:
+                ims = request.if_modified_since
+                fresco = bool(ims and modificado and modificado <= ims and ims.date() == datetime.now(timezone.utc).date())
+            rv = Response(status=304) if fresco else make_response(fn(*args, **kwargs))
+
+            if rv.status_code in (200, 304):
+                rv.set_etag(etag)
+                if modificado:
+                    rv.last_modified = modificado
+                # privada (lleva el nombre de usuario) y siempre revalidando
+                rv.cache_control.private = True
+                rv.cache_control.no_cache = True
+            return rv
+        wrapper.__name__ = fn.__name__
+        return wrapper
+    return deco
+
+
+# -------------------------
+# KPI mensual (rollup)
+# -------------------------
+# km de un viaje: por odómetro, o la distancia si no lo tiene (viajes importados)
+_KM_VIAJE_SQL = "COALESCE({r}.km_fin - {r}.km_inicio, {r}.distancia_km, 0)"
+
+# Por cada tabla origen: columna de fecha, camión, conductor y qué suma a cada KPI.
+# "{r}" es la fila (NEW/OLD en los triggers, alias en el rebuild).
+KPI_FUENTES = {
+    "viajes": {
+        "fecha": "fecha",
+        "camion_id": "camion_id",
+        "conductor_id": "conductor_id",
+        "kpis": {
+            "viajes": "1",
+            "km": _KM_VIAJE_SQL,
+            "km_vacio": f"CASE WHEN {{r}}.tipo_tramo='VACIO' THEN {_KM_VIAJE_SQL} ELSE 0 END",
+            "ingresos": "{r}.ingreso",
+            "peajes": "{r}.peajes",
+            "parking": "{r}.parking",
+        },
+    },
+    "repostajes": {
+        "fecha": "fecha",
+        "camion_id": "camion_id",
+        "conductor_id": "conductor_id",
+        "kpis": {
+            "repostajes": "1",
+            "litros": "{r}.litros",
+            "gasoil_importe": "{r}.importe",
+        },
+    },
+    "tacografo": {
+        "fecha": "fecha",
+        "camion_id": None,
+        "conductor_id": "conductor_id",
+        "kpis": {
+            "horas_conduccion": "{r}.horas_conduccion",
+            "horas_disponibilidad": "{r}.horas_disponibilidad",
+        },
+    },
+}
+
+KPI_COLUMNAS = [k for f in KPI_FUENTES.values() for k in f["kpis"]]
+
+_FILA_COL_RE = re.compile(r"\{r\}\.(\w+)")
+
+
+def _cols_fila(*exprs):
+    """Columnas de la fila ({r}.col) que leen unas expresiones: para AFTER UPDATE OF."""
+    return sorted({c for e in exprs for c in _FILA_COL_RE.findall(e)})
+
+
+def _kpi_keys_sql(fuente, r):
+    camion = f"IFNULL({r}.{fuente['camion_id']},0)" if fuente["camion_id"] else "0"
+    conductor = f"IFNULL({r}.{fuente['conductor_id']},0)" if fuente["conductor_id"] else "0"
+    return f"substr({r}.{fuente['fecha']},1,7)", camion, conductor
+
+
+def _kpi_upsert_sql(fuente, r, signo):
+    mes, camion, conductor = _kpi_keys_sql(fuente, r)
+    cols = list(fuente["kpis"])
+    vals = [f"{signo}({fuente['kpis'][c].format(r=r)})" for c in cols]
+    sets = ", ".join(f"{c}={c}+excluded.{c}" for c in cols)
+    return f"""
+      INSERT INTO kpi_mensual(mes, camion_id, conductor_id, {", ".join(cols)})
+      VALUES({mes}, {camion}, {conductor}, {", ".join(vals)})
+      ON CONFLICT(mes, camion_id, conductor_id) DO UPDATE SET {sets};"""
+
+
+def init_kpi_mensual(cur):
+    """
+    Tabla kpi_mensual (mes × camión × conductor) mantenida por triggers en la misma
+    transacción que cada INSERT/UPDATE/DELETE de viajes, repostajes y tacógrafo.
+    camion_id/conductor_id = 0 significa "sin asignar".
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='kpi_mensual'")
+    existia = cur.fetchone() is not None
+
+    cols_sql = ",\n      ".join(f"{c} REAL NOT NULL DEFAULT 0" for c in KPI_COLUMNAS)
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS kpi_mensual (
+      mes TEXT NOT NULL,
+      camion_id INTEGER NOT NULL DEFAULT 0,
+      conductor_id INTEGER NOT NULL DEFAULT 0,
+      {cols_sql},
+      PRIMARY KEY (mes, camion_id, conductor_id)
+    ) WITHOUT ROWID
+    """)
+
+    for table, fuente in KPI_FUENTES.items():
+        # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+        for ev in ("ins", "del", "upd"):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_kpi_{ev}")
+        # solo UPDATE de columnas que cuentan: p. ej. asignar ruta_id no toca kpi_mensual
+        cols_upd = sorted(
+            {fuente["fecha"]} | {fuente[k] for k in ("camion_id", "conductor_id") if fuente[k]}
+            | set(_cols_fila(*fuente["kpis"].values()))
+        )
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_kpi_ins AFTER INSERT ON {table} BEGIN
+          {_kpi_upsert_sql(fuente, "NEW", "+")}
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_kpi_del AFTER DELETE ON {table} BEGIN
+          {_kpi_upsert_sql(fuente, "OLD", "-")}
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_kpi_upd AFTER UPDATE OF {", ".join(cols_upd)} ON {table} BEGIN
+          {_kpi_upsert_sql(fuente, "OLD", "-")}
+          {_kpi_upsert_sql(fuente, "NEW", "+")}
+        END
+        """)
+
+    if not existia:
+        rebuild_kpi_mensual(cur)
+
+
+def rebuild_kpi_mensual(cur):
+    """Recalcula kpi_mensual desde cero (p. ej. tras importar datos con los triggers fuera)."""
+    cur.execute("DELETE FROM kpi_mensual")
+    for table, fuente in KPI_FUENTES.items():
+        mes, camion, conductor = _kpi_keys_sql(fuente, "t")
+        cols = list(fuente["kpis"])
+        sums = ", ".join(f"SUM({fuente['kpis'][c].format(r='t')})" for c in cols)
+        cur.execute(f"""
+          INSERT INTO kpi_mensual(mes, camion_id, conductor_id, {", ".join(cols)})
+          SELECT {mes}, {camion}, {conductor}, {sums}
+          FROM {table} t
+          GROUP BY 1, 2, 3
+          ON CONFLICT(mes, camion_id, conductor_id) DO UPDATE SET
+            {", ".join(f"{c}=excluded.{c}" for c in cols)}
+        """)
+
+
+@app.cli.command("rebuild-kpis")
+def rebuild_kpis_command():
+    """Reconstruye la tabla kpi_mensual."""
+    conn = get_conn()
+    rebuild_kpi_mensual(conn.cursor())
+    conn.commit()
+    click.echo("kpi_mensual reconstruida.")
+
+
+def kpis_mes(mes=None, camion_id=None, conductor_id=None):
+    """
+    KPIs agregados de un mes (YYYY-MM) o de todo el histórico si mes=None.
+    Lee solo kpi_mensual: el coste no depende del tamaño de viajes/repostajes.
+    """
+    where, params = [], []
+    if mes:
+        where.append("mes=?")
+        params.append(mes)
+    if camion_id is not None:
+        where.append("camion_id=?")
+        params.append(camion_id)
+    if conductor_id is not None:
+        where.append("conductor_id=?")
+        params.append(conductor_id)
+    sums = ", ".join(f"IFNULL(SUM({c}),0) AS {c}" for c in KPI_COLUMNAS)
+    cur = get_conn().cursor()
+    cur.execute(
+        f"SELECT {sums} FROM kpi_mensual" + (" WHERE " + " AND ".join(where) if where else ""),
+        params
+    )
+    return {k: float(v or 0) for k, v in dict(cur.fetchone()).items()}
+
+
+# -------------------------
+# Ajustes (settings con caché)
+# -------------------------
+# clave -> (valor por defecto, etiqueta en /ajustes)
+SETTINGS_DEFAULTS = {
+    "tarifa_km": (0.95, "Tarifa €/km (ruta fija)"),
+    "km_objetivo_mes": (12000.0, "KM objetivo mes"),
+    "salario_chofer_mes": (3100.0, "Coste empresa chófer / mes (€)"),
+    "alquiler_camion_mes": (1650.0, "Alquiler camión / mes (€)"),
+    "gestoria_mes": (250.0, "Gestoría / mes (€)"),
+    "autonomo_mes": (300.0, "Cuota autónomo / mes (€)"),
+    "domiciliacion_mes": (30.0, "Domiciliación / mes (€)"),
+    "seguro_mercancias_anual": (1200.0, "Seguro mercancías / año (€)"),
+    "consumo_l_100": (30.0, "Consumo estimado (L/100 km)"),
+    "precio_gasoil_est": (1.09, "Precio gasoil estimado (€/L)"),
+}
+SETTINGS_VERSION_KEY = "_version"
+# cada cuánto (s) se comprueba si otro proceso ha cambiado los ajustes
+SETTINGS_CHECK_INTERVAL = 5
+
+# empresa -> {"version", "values", "checked"}
+_settings_caches = {}
+_SETTINGS_VACIO = {"version": None, "values": {}, "checked": 0.0}
+
+
+def _settings(cur=None):
+    """
+    Todos los ajustes en un dict, cargados de una sola query y reutilizados
+    entre requests. Solo se recargan si cambia la versión guardada en settings.
+    Con cur se leen directamente de esa conexión, sin caché (init_db, workers).
+    """
+    if cur is not None:
+        cur.execute("SELECT key, value FROM settings")
+        return {r[0]: r[1] for r in cur.fetchall()}
+
+    empresa = empresa_actual()
+    cache = _settings_caches.get(empresa, _SETTINGS_VACIO)
+    now = time.time()
+    if cache["version"] is not None and now - cache["checked"] < SETTINGS_CHECK_INTERVAL:
+        return cache["values"]
+
+    cur = get_conn().cursor()
+    cur.execute("SELECT value FROM settings WHERE key=?", (SETTINGS_VERSION_KEY,))
+    row = cur.fetchone()
+    version = row["value"] if row else "0"
+    values = cache["values"]
+    if version != cache["version"]:
+        cur.execute("SELECT key, value FROM settings")
+        values = {r["key"]: r["value"] for r in cur.fetchall()}
+    # se sustituye el dict entero: los demás hilos ven el viejo o el nuevo, nunca uno a medias
+    _settings_caches[empresa] = {"version": version, "values": values, "checked": now}
+    return values
+
+
+def get_setting(key, default=None, cast=float, cur=None):
+    """Ajuste tipado. Si falta o no se puede convertir, devuelve el default (o el de SETTINGS_DEFAULTS)."""
+    if default is None and key in SETTINGS_DEFAULTS:
+        default = SETTINGS_DEFAULTS[key][0]
+    raw = _settings(cur).get(key)
+    if raw is None:
+        return default
+    try:
+        return cast(raw)
+    except (TypeError, ValueError):
+        return default
+
+
+def set_settings(values):
+    """Guarda varios ajustes y sube la versión en la misma transacción."""
+    conn = get_conn()
+    conn.executemany("""
+    INSERT INTO settings(key, value) VALUES(?,?)
+    ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, [(k, str(v)) for k, v in values.items()])
+    conn.execute("""
+    INSERT INTO settings(key, value) VALUES(?, '1')
+    ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER) + 1
+    """, (SETTINGS_VERSION_KEY,))
+    # la rentabilidad cacheada depende de tarifa y costes fijos
+    conn.execute("DELETE FROM viaje_rentabilidad")
+    conn.commit()
+    invalidate_settings()
+
+
+def invalidate_settings():
+    _settings_caches.pop(empresa_actual(), None)
+
+
+def coste_fijo_total_mes():
+    return (
+        get_setting("salario_chofer_mes")
+        + get_setting("alquiler_camion_mes")
+        + get_setting("gestoria_mes")
+        + get_setting("autonomo_mes")
+        + get_setting("domiciliacion_mes")
+        + get_setting("seguro_mercancias_anual") / 12.0
+    )
+
+
+def coste_fijo_por_km():
+    km_obj = get_setting("km_objetivo_mes")
+    if km_obj <= 0:
+        return 0.0
+    return coste_fijo_total_mes() / km_obj
+
+
+def gasoil_estimado_mes():
+    litros = get_setting("km_objetivo_mes") * get_setting("consumo_l_100") / 100.0
+    return litros * get_setting("precio_gasoil_est")
+
+
+# -------------------------
+# Estado por camión (odómetro)
+# -------------------------
+def _camion_estado_recalc_sql(camion):
+    """Recalcula la fila de un camión (tras UPDATE/DELETE, que pueden tocar el último registro)."""
+    return f"""
+      INSERT OR IGNORE INTO camion_estado(camion_id) SELECT {camion} WHERE {camion} IS NOT NULL;
+      UPDATE camion_estado SET (ultimo_viaje_id, ultimo_km, ultima_fecha, ubicacion) = (
+        SELECT id, km_fin, fecha, destino FROM viajes
+        WHERE camion_id={camion} AND km_fin IS NOT NULL ORDER BY fecha DESC, km_fin DESC, id DESC LIMIT 1
+      ) WHERE camion_id={camion};
+      UPDATE camion_estado SET (ultimo_repostaje_id, km_repostaje, fecha_repostaje) = (
+        SELECT id, km_odometro, fecha FROM repostajes
+        WHERE camion_id={camion} AND km_odometro IS NOT NULL ORDER BY id DESC LIMIT 1
+      ) WHERE camion_id={camion};"""
+
+
+def init_camion_estado(cur):
+    """
+    camion_estado: último viaje con odómetro (km/ubicación) y último repostaje con odómetro por camión.
+    Lo mantienen triggers en viajes y repostajes; en INSERT es un upsert directo,
+    en UPDATE/DELETE se recalcula solo el camión afectado. El último viaje es el de
+    mayor (fecha, km_fin): un viaje con fecha atrasada o importado no lo desplaza.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='camion_estado'")
+    existia = cur.fetchone() is not None
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS camion_estado (
+      camion_id INTEGER PRIMARY KEY,
+      ultimo_viaje_id INTEGER,
+      ultimo_km REAL,
+      ultima_fecha TEXT,
+      ubicacion TEXT,
+      ultimo_repostaje_id INTEGER,
+      km_repostaje REAL,
+      fecha_repostaje TEXT
+    )
+    """)
+
+    # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+    for table in ("viajes", "repostajes"):
+        for ev in ("ins", "upd", "del"):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_estado_{ev}")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_viajes_estado_ins AFTER INSERT ON viajes
+    WHEN NEW.camion_id IS NOT NULL AND NEW.km_fin IS NOT NULL AND NOT EXISTS (
+      SELECT 1 FROM viajes
+      WHERE camion_id = NEW.camion_id AND km_fin IS NOT NULL AND id != NEW.id
+        AND (fecha > NEW.fecha OR (fecha = NEW.fecha AND km_fin > NEW.km_fin))
+    ) BEGIN
+      INSERT INTO camion_estado(camion_id, ultimo_viaje_id, ultimo_km, ultima_fecha, ubicacion)
+      VALUES(NEW.camion_id, NEW.id, NEW.km_fin, NEW.fecha, NEW.destino)
+      ON CONFLICT(camion_id) DO UPDATE SET
+        ultimo_viaje_id=excluded.ultimo_viaje_id, ultimo_km=excluded.ultimo_km,
+        ultima_fecha=excluded.ultima_fecha, ubicacion=excluded.ubicacion;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_repostajes_estado_ins AFTER INSERT ON repostajes
+    WHEN NEW.camion_id IS NOT NULL AND NEW.km_odometro IS NOT NULL BEGIN
+      INSERT INTO camion_estado(camion_id, ultimo_repostaje_id, km_repostaje, fecha_repostaje)
+      VALUES(NEW.camion_id, NEW.id, NEW.km_odometro, NEW.fecha)
+      ON CONFLICT(camion_id) DO UPDATE SET
+        ultimo_repostaje_id=excluded.ultimo_repostaje_id, km_repostaje=excluded.km_repostaje,
+        fecha_repostaje=excluded.fecha_repostaje;
+    END
+    """)
+    for table, cols_upd in (("viajes", "camion_id, fecha, km_fin, destino"),
+                            ("repostajes", "camion_id, fecha, km_odometro")):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_estado_upd AFTER UPDATE OF {cols_upd} ON {table} BEGIN
+          {_camion_estado_recalc_sql("OLD.camion_id")}
+          {_camion_estado_recalc_sql("NEW.camion_id")}
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_estado_del AFTER DELETE ON {table} BEGIN
+          {_camion_estado_recalc_sql("OLD.camion_id")}
+        END
+        """)
+
+    if not existia:
+        rebuild_camion_estado(cur)
+
+
+def rebuild_camion_estado(cur):
+    cur.execute("DELETE FROM camion_estado")
+    cur.execute("""
+      INSERT INTO camion_estado(camion_id, ultimo_viaje_id, ultimo_km, ultima_fecha, ubicacion)
+      SELECT camion_id, id, km_fin, fecha, destino FROM (
+        SELECT camion_id, id, km_fin, fecha, destino,
+               ROW_NUMBER() OVER (PARTITION BY camion_id ORDER BY fecha DESC, km_fin DESC, id DESC) AS n
+        FROM viajes WHERE camion_id IS NOT NULL AND km_fin IS NOT NULL
+      ) WHERE n = 1
+    """)
+    cur.execute("""
+      INSERT INTO camion_estado(camion_id, ultimo_repostaje_id, km_repostaje, fecha_repostaje)
+      SELECT r.camion_id, r.id, r.km_odometro, r.fecha
+      FROM repostajes r
+      JOIN (SELECT camion_id, MAX(id) AS id FROM repostajes
+            WHERE camion_id IS NOT NULL AND km_odometro IS NOT NULL GROUP BY camion_id) last
+        ON last.id = r.id
+      WHERE true
+      ON CONFLICT(camion_id) DO UPDATE SET
+        ultimo_repostaje_id=excluded.ultimo_repostaje_id, km_repostaje=excluded.km_repostaje,
+        fecha_repostaje=excluded.fecha_repostaje
+    """)
+
+
+def get_camion_estado(camion_id, cur=None):
+    """Estado del camión (dict) o None. km_actual = mayor lectura conocida (viaje o repostaje)."""
+    cur = cur or get_conn().cursor()
+    cur.execute("SELECT * FROM camion_estado WHERE camion_id=?", (camion_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    estado = dict(row)
+    lecturas = [k for k in (estado["ultimo_km"], estado["km_repostaje"]) if k is not None]
+    estado["km_actual"] = max(lecturas) if lecturas else None
+    return estado
+
+
+def check_km_continuidad(camion_id, fecha, km_inicio, cur=None):
+    """
+    Mensaje de error si km_inicio retrocede respecto al último viaje del camión
+    (salvo viajes con fecha anterior, que se están metiendo a posteriori). "" si está bien.
+    """
+    if camion_id is None:
+        return ""
+    estado = get_camion_estado(camion_id, cur)
+    if not estado or estado["ultimo_km"] is None:
+        return ""
+    if km_inicio < estado["ultimo_km"] and fecha >= (estado["ultima_fecha"] or ""):
+        return (
+            f"km_inicio ({km_inicio:.0f}) es menor que el último km registrado "
+            f"para este camión ({estado['ultimo_km']:.0f})."
+        )
+    return ""
+
+
+# -------------------------
+# Tacógrafo: cumplimiento Reglamento (CE) 561/2006
+# -------------------------
+EU561 = {
+    "diaria_max": 9.0,              # h conducción/día
+    "diaria_ampliada": 10.0,        # hasta 10 h ...
+    "ampliaciones_semana": 2,       # ... dos veces por semana
+    "semanal_max": 56.0,
+    "bisemanal_max": 90.0,          # dos semanas consecutivas
+    "descanso_diario": 11.0,
+    "descanso_reducido": 9.0,
+    "reducidos_max": 3,             # descansos diarios reducidos entre descansos semanales
+    "semanal_regular": 45.0,        # descanso semanal normal
+    "semanal_reducido": 24.0,       # descanso semanal reducido, a compensar ...
+    "compensacion_semanas": 3,      # ... antes de acabar la 3.ª semana siguiente
+    "periodos_sin_semanal": 6,      # periodos de 24 h seguidos sin descanso semanal
+}
+
+# lunes de la semana de una fecha (las semanas del reglamento van de lunes a domingo)
+_SEMANA_SQL = "date({f}, 'weekday 0', '-6 days')"
+
+
+def _tacografo_semana_recalc_sql(conductor, fecha):
+    """
+    Recalcula solo la semana (≤ 7 días, por el índice conductor_id+fecha) de ese conductor.
+    Las filas del reloj sin sesiones de descanso no tienen el descanso registrado (0):
+    no cuentan para el descanso del día, y un día sin ningún descanso registrado no
+    entra en las reglas de descanso.
+    Para el descanso semanal guarda, de lunes a domingo, qué días no tienen actividad
+    (dias_libres, '1' = libre) y el descanso registrado de cada día (descanso_dias, JSON).
+    """
+    semana = _SEMANA_SQL.format(f=fecha)
+    dias = [f"date({semana}, '+{k} days')" for k in range(7)]
+    libres = " || ".join(f"CASE WHEN IFNULL(MAX(dia = {dia} AND act > 0), 0) THEN '0' ELSE '1' END" for dia in dias)
+    descansos = ", ".join(f"MAX(CASE WHEN dia = {dia} THEN d END)" for dia in dias)
+    return f"""
+      INSERT OR REPLACE INTO tacografo_semana(
+        conductor_id, semana, horas_conduccion, dias_conduccion, dias_ampliados, dias_exceso,
+        descansos_reducidos, descansos_insuficientes, dias_libres, descanso_dias)
+      SELECT * FROM (
+      SELECT {conductor}, {semana}, IFNULL(SUM(h), 0), IFNULL(SUM(h > 0), 0),
+             IFNULL(SUM(h > {EU561["diaria_max"]} AND h <= {EU561["diaria_ampliada"]}), 0),
+             IFNULL(SUM(h > {EU561["diaria_ampliada"]}), 0),
+             IFNULL(SUM(h > 0 AND d IS NOT NULL AND d >= {EU561["descanso_reducido"]} AND d < {EU561["descanso_diario"]}), 0),
+             IFNULL(SUM(h > 0 AND d IS NOT NULL AND d < {EU561["descanso_reducido"]}), 0),
+             {libres}, json_array({descansos})
+      FROM (
+        SELECT substr(fecha, 1, 10) AS dia, SUM(horas_conduccion) AS h,
+               SUM(horas_conduccion) + SUM(horas_disponibilidad) AS act,
+               MAX(CASE WHEN origen = 'reloj' AND horas_descanso = 0 THEN NULL ELSE horas_descanso END) AS d
+        FROM tacografo
+        WHERE conductor_id = {conductor}
+          AND fecha >= {semana} AND fecha < date({semana}, '+7 days')
+        GROUP BY substr(fecha, 1, 10)
+      )
+      )
+      WHERE {conductor} IS NOT NULL;"""
+
+
+def init_tacografo_semana(cur):
+    """
+    tacografo_semana: agregados por conductor y semana (lunes) para las reglas 561/2006.
+    Los triggers de tacografo recalculan solo la semana tocada, nunca el histórico.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tacografo_semana'")
+    existia = cur.fetchone() is not None
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tacografo_semana (
+      conductor_id INTEGER NOT NULL,
+      semana TEXT NOT NULL,
+      horas_conduccion REAL NOT NULL DEFAULT 0,
+      dias_conduccion INTEGER NOT NULL DEFAULT 0,
+      dias_ampliados INTEGER NOT NULL DEFAULT 0,
+      dias_exceso INTEGER NOT NULL DEFAULT 0,
+      descansos_reducidos INTEGER NOT NULL DEFAULT 0,
+      descansos_insuficientes INTEGER NOT NULL DEFAULT 0,
+      dias_libres TEXT NOT NULL DEFAULT '1111111',
+      descanso_dias TEXT,
+      PRIMARY KEY (conductor_id, semana)
+    ) WITHOUT ROWID
+    """)
+    ensure_column(cur, "tacografo_semana", "dias_libres", "dias_libres TEXT NOT NULL DEFAULT '1111111'")
+    ensure_column(cur, "tacografo_semana", "descanso_dias", "descanso_dias TEXT")
+
+    # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+    for ev in ("ins", "upd", "del"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_tacografo_semana_{ev}")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_tacografo_semana_ins AFTER INSERT ON tacografo BEGIN
+      {_tacografo_semana_recalc_sql("NEW.conductor_id", "NEW.fecha")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_tacografo_semana_upd AFTER UPDATE ON tacografo BEGIN
+      {_tacografo_semana_recalc_sql("OLD.conductor_id", "OLD.fecha")}
+      {_tacografo_semana_recalc_sql("NEW.conductor_id", "NEW.fecha")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_tacografo_semana_del AFTER DELETE ON tacografo BEGIN
+      {_tacografo_semana_recalc_sql("OLD.conductor_id", "OLD.fecha")}
+    END
+    """)
+
+    if not existia:
+        rebuild_tacografo_semana(cur)
+
+
+def rebuild_tacografo_semana(cur):
+    cur.execute("DELETE FROM tacografo_semana")
+    cur.execute("""
+      SELECT DISTINCT conductor_id, date(fecha, 'weekday 0', '-6 days') AS semana
+      FROM tacografo WHERE conductor_id IS NOT NULL
+    """)
+    semanas = [{"c": r["conductor_id"], "f": r["semana"]} for r in cur.fetchall()]
+    cur.executemany(_tacografo_semana_recalc_sql(":c", ":f"), semanas)
+
+
+def _descansos_semanales(semanas, hoy):
+    """
+    Descansos semanales de un conductor a partir de dias_libres/descanso_dias de sus
+    semanas (ordenadas). Con totales diarios, un descanso semanal son días seguidos sin
+    actividad: 24 h por día más el descanso registrado el día de trabajo anterior.
+    Las semanas sin filas cuentan como libres; los días posteriores a `hoy`, no.
+    Devuelve (bloques [(inicio, horas)], semanas enteras libres, excesos de días
+    seguidos {semana: días}, descanso diario {fecha: horas}).
+    """
+    dias = {}
+    for r in semanas:
+        lunes = date.fromisoformat(r["semana"])
+        descansos = json.loads(r["descanso_dias"] or "[]") + [None] * 7
+        for k in range(7):
+            dias[lunes + timedelta(days=k)] = (r["dias_libres"][k] == "1", descansos[k])
+    primero = date.fromisoformat(semanas[0]["semana"])
+    # lo bastante después de la última semana para cerrar bloques y compensaciones
+    ultimo = min(hoy, date.fromisoformat(semanas[-1]["semana"]) + timedelta(days=7 * (EU561["compensacion_semanas"] + 2)))
+
+    bloques, libres_por_semana, excesos, diarios = [], {}, {}, {}
+    inicio, trabajo, anterior, semana_exceso = None, 0, None, None
+    dia = primero
+    while dia <= ultimo:
+        libre, d = dias.get(dia, (True, None))
+        semana = dia - timedelta(days=dia.weekday())
+        libres_por_semana[semana] = libres_por_semana.get(semana, 0) + libre
+        if libre:
+            if inicio is None:
+                inicio = dia
+            trabajo = 0
+        else:
+            if inicio is not None:
+                bloques.append((inicio, 24.0 * (dia - inicio).days + (anterior or 0)))
+                inicio = None
+            trabajo += 1
+            if trabajo == EU561["periodos_sin_semanal"] + 1:
+                semana_exceso = semana
+            if trabajo > EU561["periodos_sin_semanal"]:
+                excesos[semana_exceso] = trabajo
+            if d is not None:
+                diarios[dia] = d
+            anterior = d
+        dia += timedelta(days=1)
+    if inicio is not None:
+        bloques.append((inicio, 24.0 * (ultimo - inicio).days + 24.0 + (anterior or 0)))
+    enteras = {s for s, n in libres_por_semana.items() if n == 7}
+    return bloques, enteras, excesos, diarios
+
+
+def _alertas_descanso_semanal(semanas, hoy):
+    """
+    Reglas del descanso semanal (art. 8.6) para un conductor: en dos semanas seguidas,
+    dos descansos semanales y al menos uno normal (45 h); un reducido (24 h) se compensa
+    con lo que le faltó, pegado a otro descanso de al menos 9 h, antes de que acabe la
+    tercera semana siguiente; y no más de seis periodos de 24 h sin descanso semanal.
+    Solo se evalúan semanas ya terminadas. Devuelve [(semana, regla, detalle)].
+    """
+    bloques, enteras, excesos, diarios = _descansos_semanales(semanas, hoy)
+    mejor = {}
+    for inicio, horas in bloques:
+        semana = inicio - timedelta(days=inicio.weekday())
+        mejor[semana] = max(mejor.get(semana, 0), horas)
+
+    def tipo(semana):
+        horas = 7 * 24.0 if semana in enteras else mejor.get(semana, 0)
+        if horas >= EU561["semanal_regular"]:
+            return "regular"
+        if horas >= EU561["semanal_reducido"]:
+            return "reducido"
+        return None
+
+    out = []
+    primera = date.fromisoformat(semanas[0]["semana"])
+    usados = set()
+    for r in semanas:
+        semana = date.fromisoformat(r["semana"])
+        if semana + timedelta(days=7) > hoy:
+            continue
+        if semana in excesos:
+            out.append((r["semana"], "periodos_sin_semanal",
+                        f"{excesos[semana]} días seguidos de trabajo sin descanso semanal "
+                        f"(máx. {EU561['periodos_sin_semanal']})"))
+        previa = semana - timedelta(days=7)
+        if previa >= primera:
+            tipos = [tipo(previa), tipo(semana)]
+            regulares, reducidos = tipos.count("regular"), tipos.count("reducido")
+            if regulares == 0 or regulares + reducidos < 2:
+                out.append((r["semana"], "descanso_semanal",
+                            f"{regulares} descanso(s) semanal(es) normal(es) y {reducidos} reducido(s) "
+                            f"en dos semanas (mín. uno normal y otro al menos reducido)"))
+        if tipo(semana) != "reducido":
+            continue
+        # compensación: el mayor bloque reducido de la semana, con otro descanso posterior
+        # (semanal o diario de ≥ 9 h) que lleve encima las horas que le faltaron
+        inicio_red, horas_red = max(
+            ((i, h) for i, h in bloques if i - timedelta(days=i.weekday()) == semana), key=lambda b: b[1]
+        )
+        falta = EU561["semanal_regular"] - horas_red
+        limite = semana + timedelta(days=7 * (EU561["compensacion_semanas"] + 1))
+        candidatos = [(i, h - EU561["semanal_regular"]) for i, h in bloques]
+        candidatos += [(dia, d - EU561["descanso_reducido"]) for dia, d in diarios.items()
+                       if d >= EU561["descanso_reducido"]]
+        compensado = None
+        for inicio, sobra in sorted(candidatos):
+            if inicio_red < inicio < limite and sobra >= falta and inicio not in usados:
+                compensado = inicio
+                break
+        if compensado is not None:
+            usados.add(compensado)
+        elif limite <= hoy:
+            out.append((r["semana"], "compensacion",
+                        f"descanso semanal reducido de {horas_red:.0f} h sin compensar las "
+                        f"{falta:.0f} h que faltan antes del {limite.isoformat()}"))
+    return out
+
+
+def tacografo_alertas(conductor_id=None, desde=None, cur=None, hoy=None):
+    """
+    Incumplimientos por conductor y semana, leyendo solo tacografo_semana.
+    La regla bisemanal usa LAG sobre la semana anterior del mismo conductor; las de
+    descanso semanal leen también las semanas de alrededor (_alertas_descanso_semanal).
+    """
+    cur = cur or get_conn().cursor()
+    hoy = hoy or date.today()
+    where, params = [], []
+    if conductor_id is not None:
+        where.append("conductor_id = ?")
+        params.append(conductor_id)
+    cur.execute(f"""
+      SELECT * FROM (
+        SELECT s.*,
+               CASE WHEN LAG(semana) OVER w = date(semana, '-7 days')
+                    THEN LAG(horas_conduccion) OVER w ELSE 0 END AS horas_semana_anterior
+        FROM tacografo_semana s
+        {"WHERE " + " AND ".join(where) if where else ""}
+        WINDOW w AS (PARTITION BY conductor_id ORDER BY semana)
+      )
+      WHERE semana >= IFNULL(date(?, '-35 days'), ?)
+      ORDER BY semana DESC, conductor_id
+    """, params + [desde, desde or ""])
+    filas = cur.fetchall()
+
+    por_conductor = {}
+    for r in filas:
+        por_conductor.setdefault(r["conductor_id"], []).insert(0, r)
+    semanales = {}
+    for cid, semanas in por_conductor.items():
+        for semana, regla, detalle in _alertas_descanso_semanal(semanas, hoy):
+            semanales.setdefault((cid, semana), []).append((regla, True, detalle))
+
+    alertas = []
+    for r in filas:
+        if desde and r["semana"] < desde:
+            continue
+        base = {"conductor_id": r["conductor_id"], "semana": r["semana"]}
+        bisemanal = r["horas_conduccion"] + r["horas_semana_anterior"]
+        checks = [
+            ("conduccion_diaria", r["dias_exceso"] > 0,
+             f"{r['dias_exceso']} día(s) con más de {EU561['diaria_ampliada']:.0f} h de conducción"),
+            ("ampliaciones", r["dias_ampliados"] > EU561["ampliaciones_semana"],
+             f"{r['dias_ampliados']} días de 10 h (máx. {EU561['ampliaciones_semana']})"),
+            ("conduccion_semanal", r["horas_conduccion"] > EU561["semanal_max"],
+             f"{r['horas_conduccion']:.1f} h en la semana (máx. {EU561['semanal_max']:.0f})"),
+            ("conduccion_bisemanal", bisemanal > EU561["bisemanal_max"],
+             f"{bisemanal:.1f} h en dos semanas (máx. {EU561['bisemanal_max']:.0f})"),
+            ("descansos_reducidos", r["descansos_reducidos"] > EU561["reducidos_max"],
+             f"{r['descansos_reducidos']} descansos reducidos (máx. {EU561['reducidos_max']})"),
+            ("descanso_insuficiente", r["descansos_insuficientes"] > 0,
+             f"{r['descansos_insuficientes']} día(s) con menos de {EU561['descanso_reducido']:.0f} h de descanso"),
+        ] + semanales.get((r["conductor_id"], r["semana"]), [])
+        for regla, falla, detalle in checks:
+            if falla:
+                alertas.append({**base, "regla": regla, "detalle": detalle})
+    return alertas
+
+
+# -------------------------
+# Tacógrafo: sesiones start/stop
+# -------------------------
+ACTIVIDADES = {
+    "conduccion": "horas_conduccion",
+    "disponibilidad": "horas_disponibilidad",
+    "descanso": "horas_descanso",
+}
+
+
+def hora_local(dt):
+    """Las sesiones se guardan en hora local del servidor sin zona, como datetime.now()."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.replace(microsecond=0)
+
+
+def split_por_dia(inicio, fin):
+    """[(fecha, horas), ...] de un intervalo, partido en las medianoches que cruce."""
+    out = []
+    t = inicio
+    while t < fin:
+        medianoche = datetime.combine(t.date(), datetime.min.time()).replace(tzinfo=t.tzinfo)
+        corte = min(fin, medianoche + timedelta(days=1))
+        out.append((t.date().isoformat(), (corte - t).total_seconds() / 3600.0))
+        t = corte
+    return out
+
+
+def sesion_abierta(cur, conductor_id):
+    cur.execute(
+        "SELECT * FROM tacografo_sesiones WHERE conductor_id=? AND fin IS NULL ORDER BY id DESC LIMIT 1",
+        (conductor_id,)
+    )
+    return cur.fetchone()
+
+
+def cerrar_sesion(cur, sesion, fin, pausada=False):
+    """
+    Cierra la sesión y suma sus horas (partidas por día) a la fila diaria origen='reloj'
+    del tacógrafo. Solo se toca el/los día(s) del intervalo.
+    """
+    inicio = datetime.fromisoformat(sesion["inicio"])
+    fin = max(fin, inicio)
+    cur.execute(
+        "UPDATE tacografo_sesiones SET fin=?, pausada=? WHERE id=?",
+        (fin.isoformat(timespec="seconds"), 1 if pausada else 0, sesion["id"])
+    )
+    sumar_sesion(cur, sesion["conductor_id"], sesion["actividad"], inicio, fin)
+
+
+def sumar_sesion(cur, conductor_id, actividad, inicio, fin):
+    """Suma un intervalo cerrado a las filas diarias origen='reloj' que toca."""
+    col = ACTIVIDADES[actividad]
+    for fecha, horas in split_por_dia(inicio, fin):
+        cur.execute("""
+          INSERT INTO tacografo(conductor_id, fecha, horas_conduccion, horas_disponibilidad, horas_descanso, comentario, origen)
+          VALUES(?, ?, 0, 0, 0, 'reloj', 'reloj')
+          ON CONFLICT(conductor_id, fecha) WHERE origen='reloj' DO NOTHING
+        """, (conductor_id, fecha))
+        cur.execute(
+            f"UPDATE tacografo SET {col} = ROUND({col} + ?, 4) WHERE conductor_id=? AND fecha=? AND origen='reloj'",
+            (horas, conductor_id, fecha)
+        )
+
+
+def sesion_accion(cur, conductor_id, accion, actividad=None, ts=None, user_id=None):
+    """
+    start: abre una sesión de `actividad` (cerrando la que hubiera); sin actividad reanuda la pausada.
+    pause / stop: cierra la sesión abierta (pause la deja marcada para reanudar).
+    Devuelve (sesión actual o None, error).
+    """
+    ts = ts or datetime.now().replace(microsecond=0)
+    abierta = sesion_abierta(cur, conductor_id)
+    if abierta and ts < datetime.fromisoformat(abierta["inicio"]):
+        return abierta, "La hora es anterior al inicio de la sesión abierta."
+
+    if accion in ("pause", "stop"):
+        if not abierta:
+            return None, "No hay ninguna sesión abierta."
+        cerrar_sesion(cur, abierta, ts, pausada=accion == "pause")
+        return None, ""
+
+    if accion != "start":
+        return abierta, "Acción no válida."
+
+    if not actividad:
+        cur.execute(
+            "SELECT actividad, pausada FROM tacografo_sesiones WHERE conductor_id=? ORDER BY id DESC LIMIT 1",
+            (conductor_id,)
+        )
+        last = cur.fetchone()
+        actividad = last["actividad"] if last and last["pausada"] else None
+    if actividad not in ACTIVIDADES:
+        return abierta, "Actividad no válida (conduccion, disponibilidad o descanso)."
+
+    if abierta:
+        cerrar_sesion(cur, abierta, ts)
+    try:
+        cur.execute(
+            "INSERT INTO tacografo_sesiones(conductor_id, actividad, inicio, created_by_user_id) VALUES(?,?,?,?)",
+            (conductor_id, actividad, ts.isoformat(timespec="seconds"), user_id)
+        )
+    except sqlite3.IntegrityError:
+        # otro start concurrente abrió sesión entre la lectura y el INSERT (ux_tacografo_sesiones_abierta)
+        return sesion_abierta(cur, conductor_id), "Ya hay una sesión abierta."
+    return sesion_abierta(cur, conductor_id), ""
+
+
+# -------------------------
+# Consumo de gasoil por camión (lleno a lleno)
+# -------------------------
+CONSUMO_TOLERANCIA = 0.25      # ±25 % sobre la referencia del camión
+CONSUMO_REF_TRAMOS = 10        # tramos recientes para la referencia (mediana)
+CONSUMO_KM_MAX_TRAMO = 4000    # más km entre dos llenos suele ser un odómetro mal tecleado
+# columnas de repostajes que entran en los tramos: al cambiar alguna se recalcula el camión
+CONSUMO_COLS = ("camion_id", "tipo", "fecha", "km_odometro", "litros", "importe", "lleno")
+
+
+def init_consumo(cur):
+    """
+    consumo_tramos: un tramo por repostaje lleno, desde el lleno anterior del mismo camión.
+    El INSERT lo recalcula actualizar_consumo(); en UPDATE/DELETE de repostajes los triggers
+    apuntan el camión y el odómetro en consumo_pendiente y consumo_refresh() lo recalcula
+    en la siguiente consulta.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='consumo_tramos'")
+    existia = cur.fetchone() is not None
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS consumo_tramos (
+      repostaje_id INTEGER PRIMARY KEY,
+      camion_id INTEGER NOT NULL,
+      fecha TEXT NOT NULL,
+      mes TEXT NOT NULL,
+      km_desde REAL NOT NULL,
+      km_hasta REAL NOT NULL,
+      km REAL NOT NULL,
+      litros REAL NOT NULL,
+      l_100km REAL,
+      anomalia TEXT
+    )
+    """)
+    nueva_col = ensure_column(cur, "consumo_tramos", "importe", "importe REAL NOT NULL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_consumo_tramos_camion ON consumo_tramos(camion_id, km_hasta)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_consumo_tramos_mes ON consumo_tramos(mes, camion_id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS consumo_pendiente (
+      camion_id INTEGER PRIMARY KEY,
+      desde_km REAL NOT NULL
+    )
+    """)
+    # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+    for ev in ("update", "delete"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_repostajes_consumo_{ev}")
+    # -1 (odómetro desconocido) = recalcular el camión entero
+    pendiente = """
+      INSERT INTO consumo_pendiente(camion_id, desde_km)
+      SELECT {ref}.camion_id, IFNULL({ref}.km_odometro, -1) WHERE {ref}.camion_id IS NOT NULL
+      ON CONFLICT(camion_id) DO UPDATE SET desde_km=MIN(desde_km, excluded.desde_km);"""
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_repostajes_consumo_update AFTER UPDATE OF {', '.join(CONSUMO_COLS)} ON repostajes BEGIN
+      {pendiente.format(ref="OLD")}
+      {pendiente.format(ref="NEW")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_repostajes_consumo_delete AFTER DELETE ON repostajes BEGIN
+      {pendiente.format(ref="OLD")}
+    END
+    """)
+    if not existia or nueva_col:
+        cur.execute("SELECT DISTINCT camion_id FROM repostajes WHERE camion_id IS NOT NULL")
+        for r in cur.fetchall():
+            recalc_consumo(cur, r["camion_id"])
+
+
+def _consumo_referencia(cur, camion_id, antes_de_km):
+    cur.execute("""
+      SELECT l_100km FROM consumo_tramos
+      WHERE camion_id=? AND km_hasta < ? AND anomalia IS NULL AND l_100km IS NOT NULL
+      ORDER BY km_hasta DESC LIMIT ?
+    """, (camion_id, antes_de_km, CONSUMO_REF_TRAMOS))
+    vals = sorted(r["l_100km"] for r in cur.fetchall())
+    if len(vals) < 3:
+        return get_setting("consumo_l_100", cur=cur)
+    return vals[len(vals) // 2]
+
+
+def recalc_consumo(cur, camion_id, desde_km=None):
+    """
+    Recalcula los tramos del camión a partir de desde_km (todos si es None).
+    Con funciones ventana: cada repostaje lleno cierra un tramo que suma los litros
+    de los parciales desde el lleno anterior. Al insertar un repostaje nuevo solo
+    se recorre desde el lleno anterior a su odómetro, no todo el histórico.
+    """
+    inicio_km = -1.0
+    if desde_km is not None:
+        cur.execute("""
+          SELECT MAX(km_odometro) AS km FROM repostajes
+          WHERE camion_id=? AND tipo='gasoil' AND lleno=1 AND km_odometro < ?
+        """, (camion_id, desde_km))
+        row = cur.fetchone()
+        inicio_km = row["km"] if row and row["km"] is not None else -1.0
+
+    cur.execute("DELETE FROM consumo_tramos WHERE camion_id=? AND km_hasta > ?", (camion_id, inicio_km))
+    cur.execute("""
+      WITH r AS (
+        SELECT id, fecha, km_odometro, litros, importe, lleno,
+               -- nº de llenos anteriores: agrupa cada lleno con los parciales que lo preceden
+               IFNULL(SUM(lleno) OVER (ORDER BY km_odometro, id
+                                       ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS tramo,
+               MAX(CASE WHEN lleno=1 THEN km_odometro END) OVER (ORDER BY km_odometro, id
+                                       ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS km_lleno_prev
+        FROM repostajes
+        WHERE camion_id=? AND tipo='gasoil' AND km_odometro IS NOT NULL AND km_odometro >= ?
+      ),
+      t AS (
+        SELECT tramo, SUM(litros) AS litros, SUM(importe) AS importe FROM r WHERE tramo > 0 GROUP BY tramo
+      )
+      SELECT r.id, r.fecha, r.km_odometro AS km_hasta, r.km_lleno_prev AS km_desde, t.litros, t.importe
+      FROM r JOIN t ON t.tramo = r.tramo
+      WHERE r.lleno = 1 AND r.km_lleno_prev IS NOT NULL
+      ORDER BY r.km_odometro, r.id
+    """, (camion_id, inicio_km if inicio_km >= 0 else -1.0))
+    tramos = cur.fetchall()
+
+    for t in tramos:
+        km = t["km_hasta"] - t["km_desde"]
+        l_100 = t["litros"] * 100.0 / km if km > 0 else None
+        anomalia = None
+        if km <= 0 or km > CONSUMO_KM_MAX_TRAMO:
+            anomalia = "odometro"
+        else:
+            ref = _consumo_referencia(cur, camion_id, t["km_hasta"])
+            if ref > 0 and l_100 > ref * (1 + CONSUMO_TOLERANCIA):
+                anomalia = "consumo_alto"      # posible robo de gasoil o fuga
+            elif ref > 0 and l_100 < ref * (1 - CONSUMO_TOLERANCIA):
+                anomalia = "consumo_bajo"      # odómetro mal o repostaje parcial no marcado
+        cur.execute("""
+          INSERT OR REPLACE INTO consumo_tramos(repostaje_id, camion_id, fecha, mes, km_desde, km_hasta, km, litros, importe, l_100km, anomalia)
+          VALUES(?,?,?,?,?,?,?,?,?,?,?)
+        """, (t["id"], camion_id, t["fecha"], t["fecha"][:7], t["km_desde"], t["km_hasta"], km, t["litros"], t["importe"], l_100, anomalia))
+
+
+def actualizar_consumo(cur, repostaje_id):
+    """Hook tras insertar un repostaje: recalcula solo el/los tramo(s) afectados."""
+    cur.execute("SELECT camion_id, km_odometro, tipo FROM repostajes WHERE id=?", (repostaje_id,))
+    r = cur.fetchone()
+    if r and r["camion_id"] is not None and r["km_odometro"] is not None and r["tipo"] == "gasoil":
+        recalc_consumo(cur, r["camion_id"], r["km_odometro"])
+
+
+def consumo_refresh(cur):
+    """Recalcula los camiones apuntados en consumo_pendiente (repostajes editados o borrados)."""
+    cur.execute("SELECT camion_id, desde_km FROM consumo_pendiente")
+    pendientes = cur.fetchall()
+    for r in pendientes:
+        recalc_consumo(cur, r["camion_id"], r["desde_km"] if r["desde_km"] >= 0 else None)
+    if pendientes:
+        cur.execute("DELETE FROM consumo_pendiente")
+    return len(pendientes)
+
+
+@app.cli.command("rebuild-consumo")
+def rebuild_consumo_command():
+    """Recalcula consumo_tramos para todos los camiones."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM consumo_tramos")
+    cur.execute("DELETE FROM consumo_pendiente")
+    cur.execute("SELECT DISTINCT camion_id FROM repostajes WHERE camion_id IS NOT NULL")
+    for r in cur.fetchall():
+        recalc_consumo(cur, r["camion_id"])
+    conn.commit()
+    click.echo("consumo_tramos reconstruida.")
+
+
+def consumo_mensual(cur, mes=None, camion_id=None):
+    where, params = [], []
+    if mes:
+        where.append("t.mes = ?")
+        params.append(mes)
+    if camion_id is not None:
+        where.append("t.camion_id = ?")
+        params.append(camion_id)
+    cur.execute(f"""
+      SELECT t.camion_id, c.matricula, t.mes, SUM(t.km) AS km, SUM(t.litros) AS litros,
+             CASE WHEN SUM(t.km) > 0 THEN SUM(t.litros) * 100.0 / SUM(t.km) END AS l_100km,
+             SUM(t.anomalia IS NOT NULL) AS anomalias
+      FROM consumo_tramos t
+      LEFT JOIN camiones c ON c.id = t.camion_id
+      WHERE t.anomalia IS NULL OR t.anomalia != 'odometro'
+      {"AND " + " AND ".join(where) if where else ""}
+      GROUP BY t.camion_id, t.mes
+      ORDER BY t.mes DESC, c.matricula
+    """, params)
+    return cur.fetchall()
+
+
+def consumo_anomalias(cur, camion_id=None, limit=200):
+    cur.execute(f"""
+      SELECT t.*, c.matricula, r.estacion, r.importe
+      FROM consumo_tramos t
+      LEFT JOIN camiones c ON c.id = t.camion_id
+      LEFT JOIN repostajes r ON r.id = t.repostaje_id
+      WHERE t.anomalia IS NOT NULL {"AND t.camion_id = ?" if camion_id is not None else ""}
+      ORDER BY t.fecha DESC, t.repostaje_id DESC
+      LIMIT ?
+    """, ([camion_id] if camion_id is not None else []) + [limit])
+    return cur.fetchall()
+
+
+# -------------------------
+# Rentabilidad por viaje
+# -------------------------
+# columnas de viajes que entran en el cálculo: al cambiar alguna se invalida la caché
+RENTABILIDAD_COLS = (
+    "camion_id", "km_inicio", "km_fin", "distancia_km", "tipo_tramo", "ingreso", "peajes", "parking",
+)
+
+
+def init_rentabilidad(cur):
+    """
+    viaje_rentabilidad: caché por viaje del cálculo de rentabilidad_refresh().
+    Los triggers borran las filas afectadas (edición del viaje o tramos de consumo
+    que lo solapan) y se recalculan en la siguiente consulta.
+    """
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS viaje_rentabilidad (
+      viaje_id INTEGER PRIMARY KEY,
+      km REAL NOT NULL,
+      ingreso REAL NOT NULL,
+      gasoil REAL NOT NULL,
+      km_gasoil_estimado REAL NOT NULL,
+      peajes REAL NOT NULL,
+      parking REAL NOT NULL,
+      fijo REAL NOT NULL,
+      margen REAL NOT NULL,
+      margen_km REAL
+    )
+    """)
+    # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+    for ev in ("update", "delete"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_viajes_rent_{ev}")
+    for ev in (f"UPDATE OF {', '.join(RENTABILIDAD_COLS)}", "DELETE"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_viajes_rent_{ev.split()[0].lower()} AFTER {ev} ON viajes BEGIN
+          DELETE FROM viaje_rentabilidad WHERE viaje_id = OLD.id;
+        END
+        """)
+    for ev, ref in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_consumo_rent_{ev.lower()} AFTER {ev} ON consumo_tramos BEGIN
+          DELETE FROM viaje_rentabilidad WHERE viaje_id IN (
+            SELECT id FROM viajes
+            WHERE camion_id = {ref}.camion_id AND km_fin > {ref}.km_desde AND km_inicio < {ref}.km_hasta
+          );
+        END
+        """)
+
+
+def rentabilidad_refresh(cur):
+    """
+    Calcula en una sola sentencia SQL los viajes que no están en la caché:
+    ingreso (o tarifa × km si es CARGADO sin ingreso), gasoil real prorrateado por los
+    km del viaje que caen en cada tramo lleno-a-lleno del camión (y estimado con los
+    ajustes para los km sin tramo), peajes, parking, fijo por km y margen.
+    """
+    gas_km_est = get_setting("consumo_l_100") / 100.0 * get_setting("precio_gasoil_est")
+    # viajes sin odómetro: no solapan ningún tramo y todo su km es estimado
+    km = _KM_VIAJE_SQL.format(r="p")
+    cur.execute(f"""
+      WITH pend AS (
+        SELECT v.* FROM viajes v
+        LEFT JOIN viaje_rentabilidad vr ON vr.viaje_id = v.id
+        WHERE vr.viaje_id IS NULL
+      ),
+      fuel AS (
+        SELECT p.id AS viaje_id,
+               SUM((MIN(p.km_fin, t.km_hasta) - MAX(p.km_inicio, t.km_desde)) * t.importe / t.km) AS gasoil,
+               SUM(MIN(p.km_fin, t.km_hasta) - MAX(p.km_inicio, t.km_desde)) AS km_cubiertos
+        FROM pend p
+        JOIN consumo_tramos t
+          ON t.camion_id = p.camion_id AND t.km_hasta > p.km_inicio AND t.km_desde < p.km_fin
+        WHERE t.km > 0 AND (t.anomalia IS NULL OR t.anomalia != 'odometro')
+        GROUP BY p.id
+      ),
+      calc AS (
+        SELECT p.id AS viaje_id,
+               MAX({km}, 0) AS km,
+               CASE WHEN p.ingreso > 0 THEN p.ingreso
+                    WHEN p.tipo_tramo = 'CARGADO' THEN MAX({km}, 0) * :tarifa
+                    ELSE 0 END AS ingreso,
+               IFNULL(f.gasoil, 0) AS gasoil_real,
+               MAX({km} - IFNULL(f.km_cubiertos, 0), 0) AS km_est,
+               p.peajes, p.parking
+        FROM pend p LEFT JOIN fuel f ON f.viaje_id = p.id
+      )
+      INSERT INTO viaje_rentabilidad(viaje_id, km, ingreso, gasoil, km_gasoil_estimado, peajes, parking, fijo, margen, margen_km)
+      SELECT viaje_id, km, ingreso,
+             gasoil_real + km_est * :gas_km_est,
+             km_est, peajes, parking, km * :fijo_km,
+             ingreso - (gasoil_real + km_est * :gas_km_est) - peajes - parking - km * :fijo_km,
+             CASE WHEN km > 0 THEN
+               (ingreso - (gasoil_real + km_est * :gas_km_est) - peajes - parking - km * :fijo_km) / km
+             END
+      FROM calc
+    """, {"tarifa": get_setting("tarifa_km"), "fijo_km": coste_fijo_por_km(), "gas_km_est": gas_km_est})
+    return cur.rowcount
+
+
+RENTABILIDAD_ORDEN = {
+    "margen": "r.margen",
+    "margen_km": "r.margen_km",
+    "ingreso": "r.ingreso",
+    "km": "r.km",
+    "fecha": "v.fecha",
+}
+
+
+def rentabilidad_viajes(cur, orden="margen", desc=False, desde=None, hasta=None, limit=200):
+    col = RENTABILIDAD_ORDEN.get(orden, "r.margen")
+    where, params = [], []
+    if desde:
+        where.append("v.fecha >= ?")
+        params.append(desde)
+    if hasta:
+        where.append("v.fecha < date(?, '+1 day')")
+        params.append(hasta)
+    cur.execute(f"""
+      SELECT v.id, v.fecha, v.origen, v.destino, v.tipo_tramo, c.matricula, r.*
+      FROM viaje_rentabilidad r
+      JOIN viajes v ON v.id = r.viaje_id
+      LEFT JOIN camiones c ON c.id = v.camion_id
+      {"WHERE " + " AND ".join(where) if where else ""}
+      ORDER BY {col} {"DESC" if desc else "ASC"}, v.id DESC
+      LIMIT ?
+    """, params + [limit])
+    return cur.fetchall()
+
+
+def rentabilidad_rutas(cur, desde=None, hasta=None, limit=50):
+    """Rutas (origen → destino) de menor a mayor margen por km."""
+    where, params = [], []
+    if desde:
+        where.append("v.fecha >= ?")
+        params.append(desde)
+    if hasta:
+        where.append("v.fecha < date(?, '+1 day')")
+        params.append(hasta)
+    cur.execute(f"""
+      SELECT ru.origen, ru.destino, COUNT(*) AS viajes,
+             SUM(r.km) AS km, SUM(r.ingreso) AS ingreso, SUM(r.margen) AS margen,
+             CASE WHEN SUM(r.km) > 0 THEN SUM(r.margen) / SUM(r.km) END AS margen_km
+      FROM viaje_rentabilidad r
+      JOIN viajes v ON v.id = r.viaje_id
+      JOIN rutas ru ON ru.id = v.ruta_id
+      {"WHERE " + " AND ".join(where) if where else ""}
+      GROUP BY v.ruta_id
+      ORDER BY margen_km ASC
+      LIMIT ?
+    """, params + [limit])
+    return cur.fetchall()
+
+
+# -------------------------
+# Rutas normalizadas (origen → destino)
+# -------------------------
+# plegado de tildes/mayúsculas para que "Vitoria", "vitoria" y "VITORIA " sean la misma ruta
+_LUGAR_FOLD = {
+    "á": "a", "à": "a", "â": "a", "ä": "a",
+    "é": "e", "è": "e", "ê": "e", "ë": "e",
+    "í": "i", "ì": "i", "î": "i", "ï": "i",
+    "ó": "o", "ò": "o", "ô": "o", "ö": "o",
+    "ú": "u", "ù": "u", "û": "u", "ü": "u",
+    "ñ": "n", "ç": "c", "-": " ", ".": "",
+}
+_LUGAR_FOLD_TABLE = str.maketrans(_LUGAR_FOLD)
+
+
+def normalizar_lugar(texto):
+    """
+    Minúsculas, sin tildes ni guiones y con espacios simples. En SQL: lugar_norm(), que
+    solo existe en las conexiones del pool: por eso no se usa en triggers.
+    """
+    return " ".join((texto or "").lower().translate(_LUGAR_FOLD_TABLE).split())
+
+
+def _lugar_canon_sql(expr):
+    norm = f"lugar_norm({expr})"
+    return f"IFNULL((SELECT lugar FROM lugares_alias WHERE alias = {norm}), {norm})"
+
+
+def _lugar_canon(cur, lugar):
+    norm = normalizar_lugar(lugar)
+    cur.execute("SELECT lugar FROM lugares_alias WHERE alias = ?", (norm,))
+    alias = cur.fetchone()
+    return alias["lugar"] if alias else norm
+
+
+def ruta_id_para(cur, origen, destino):
+    """id de la ruta normalizada origen → destino (la crea si no existe)."""
+    origen_norm, destino_norm = _lugar_canon(cur, origen), _lugar_canon(cur, destino)
+    cur.execute(
+        "INSERT OR IGNORE INTO rutas(origen_norm, destino_norm, origen, destino) VALUES(?,?,?,?)",
+        (origen_norm, destino_norm, origen, destino)
+    )
+    cur.execute("SELECT id FROM rutas WHERE origen_norm = ? AND destino_norm = ?", (origen_norm, destino_norm))
+    return cur.fetchone()["id"]
+
+
+def asignar_ruta(cur, row):
+    """Hook antes de insertar un viaje: ruta_id ya en el INSERT, sin UPDATE posterior."""
+    row["ruta_id"] = ruta_id_para(cur, row["origen"], row["destino"])
+
+
+def asignar_rutas_pendientes(cur):
+    """
+    Asigna ruta a los viajes que no la tienen: importados por lotes, escritos desde otra
+    conexión (scripts, copias) o con origen/destino cambiado. Devuelve cuántas rutas tocó.
+    """
+    cur.execute("SELECT DISTINCT origen, destino FROM viajes WHERE ruta_id IS NULL")
+    pares = cur.fetchall()
+    for p in pares:
+        cur.execute(
+            "UPDATE viajes SET ruta_id = ? WHERE ruta_id IS NULL AND origen = ? AND destino = ?",
+            (ruta_id_para(cur, p["origen"], p["destino"]), p["origen"], p["destino"])
+        )
+    return len(pares)
+
+
+# columnas de ruta_stats -> expresión por viaje
+RUTA_STATS = {
+    "viajes": "1",
+    "km": f"MAX({_KM_VIAJE_SQL}, 0)",
+    "ingreso": "{r}.ingreso",
+    "km_vacio": f"CASE WHEN {{r}}.tipo_tramo='VACIO' THEN MAX({_KM_VIAJE_SQL}, 0) ELSE 0 END",
+    "horas": "IFNULL({r}.duracion_h, 0)",
+    "viajes_con_horas": "({r}.duracion_h IS NOT NULL)",
+}
+
+
+def _ruta_stats_upsert_sql(r, signo):
+    cols = list(RUTA_STATS)
+    vals = [f"{signo}({RUTA_STATS[c].format(r=r)})" for c in cols]
+    sets = ", ".join(f"{c}={c}+excluded.{c}" for c in cols)
+    return f"""
+      INSERT INTO ruta_stats(ruta_id, {", ".join(cols)})
+      SELECT {r}.ruta_id, {", ".join(vals)} WHERE {r}.ruta_id IS NOT NULL
+      ON CONFLICT(ruta_id) DO UPDATE SET {sets};"""
+
+
+def init_rutas(cur):
+    """
+    rutas: dimensión origen → destino normalizada (minúsculas, sin tildes, alias de
+    lugares_alias). Cada viaje recibe ruta_id en Python antes del INSERT (asignar_ruta);
+    si cambia origen/destino, el trigger lo deja en NULL y asignar_rutas_pendientes lo
+    reasigna antes de leer. ruta_stats acumula por ruta los totales para medias de €/km,
+    km en vacío y duración.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ruta_stats'")
+    existia = cur.fetchone() is not None
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS lugares_alias (
+      alias TEXT PRIMARY KEY,
+      lugar TEXT NOT NULL
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rutas (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      origen_norm TEXT NOT NULL,
+      destino_norm TEXT NOT NULL,
+      origen TEXT NOT NULL,
+      destino TEXT NOT NULL,
+      UNIQUE (origen_norm, destino_norm)
+    )
+    """)
+    cols_sql = ",\n      ".join(f"{c} REAL NOT NULL DEFAULT 0" for c in RUTA_STATS)
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS ruta_stats (
+      ruta_id INTEGER PRIMARY KEY,
+      {cols_sql},
+      eur_km REAL GENERATED ALWAYS AS (CASE WHEN km > 0 THEN ingreso / km END) VIRTUAL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ruta_stats_eur_km ON ruta_stats(eur_km)")
+
+    ensure_column(cur, "viajes", "ruta_id", "ruta_id INTEGER")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_viajes_ruta_id ON viajes(ruta_id, fecha)")
+
+    # DROP + CREATE: una migración que vuelva a llamar a esta función recoge cambios del SQL
+    for ev in ("ins", "lugar", "stats_ins", "stats_upd", "stats_del"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_viajes_ruta_{ev}")
+    # sin funciones de la app (lugar_norm) en los triggers: cualquier conexión puede escribir viajes
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_viajes_ruta_lugar AFTER UPDATE OF origen, destino ON viajes
+    WHEN NEW.ruta_id IS NOT NULL AND NEW.ruta_id IS OLD.ruta_id
+      AND (NEW.origen IS NOT OLD.origen OR NEW.destino IS NOT OLD.destino) BEGIN
+      UPDATE viajes SET ruta_id = NULL WHERE id = NEW.id;
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_viajes_ruta_stats_ins AFTER INSERT ON viajes
+    WHEN NEW.ruta_id IS NOT NULL BEGIN
+      {_ruta_stats_upsert_sql("NEW", "+")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_viajes_ruta_stats_upd
+    AFTER UPDATE OF {", ".join(["ruta_id"] + _cols_fila(*RUTA_STATS.values()))} ON viajes BEGIN
+      {_ruta_stats_upsert_sql("OLD", "-")}
+      {_ruta_stats_upsert_sql("NEW", "+")}
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_viajes_ruta_stats_del AFTER DELETE ON viajes BEGIN
+      {_ruta_stats_upsert_sql("OLD", "-")}
+    END
+    """)
+
+    if not existia:
+        rebuild_rutas(cur)
+
+
+def rebuild_rutas(cur):
+    """Reasigna ruta_id a todos los viajes (p. ej. tras añadir un alias) y rehace ruta_stats."""
+    origen, destino = _lugar_canon_sql("v.origen"), _lugar_canon_sql("v.destino")
+    cur.execute(f"""
+      INSERT OR IGNORE INTO rutas(origen_norm, destino_norm, origen, destino)
+      SELECT {origen}, {destino}, MIN(v.origen), MIN(v.destino)
+      FROM viajes v GROUP BY 1, 2
+    """)
+    cur.execute(f"""
+      UPDATE viajes AS v SET ruta_id = r.id
+      FROM rutas r
+      WHERE r.origen_norm = {origen} AND r.destino_norm = {destino}
+        AND v.ruta_id IS NOT r.id
+    """)
+    cur.execute("DELETE FROM rutas WHERE id NOT IN (SELECT ruta_id FROM viajes WHERE ruta_id IS NOT NULL)")
+
+    cols = list(RUTA_STATS)
+    cur.execute("DELETE FROM ruta_stats")
+    cur.execute(f"""
+      INSERT INTO ruta_stats(ruta_id, {", ".join(cols)})
+      SELECT v.ruta_id, {", ".join(f"SUM({RUTA_STATS[c].format(r='v')})" for c in cols)}
+      FROM viajes v WHERE v.ruta_id IS NOT NULL
+      GROUP BY v.ruta_id
+    """)
+
+
+@app.cli.command("ruta-alias")
+@click.argument("alias")
+@click.argument("lugar")
+def ruta_alias_command(alias, lugar):
+    """Trata ALIAS como LUGAR (p. ej. "bcn" → "Barcelona") y reagrupa las rutas."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("""
+    INSERT INTO lugares_alias(alias, lugar) VALUES(?,?)
+    ON CONFLICT(alias) DO UPDATE SET lugar=excluded.lugar
+    """, (normalizar_lugar(alias), normalizar_lugar(lugar)))
+    rebuild_rutas(cur)
+    conn.commit()
+    click.echo(f"{alias} → {lugar}")
+
+
+@app.cli.command("rebuild-rutas")
+def rebuild_rutas_command():
+    conn = get_conn()
+    rebuild_rutas(conn.cursor())
+    conn.commit()
+    click.echo("rutas recalculadas")
+
+
+RUTAS_ORDEN = {
+    "eur_km": "s.eur_km",
+    "viajes": "s.viajes",
+    "km_vacio": "km_vacio_medio",
+}
+
+
+def rutas_resumen(cur, orden="eur_km", desc=False, limit=100):
+    col = RUTAS_ORDEN.get(orden, "s.eur_km")
+    cur.execute(f"""
+      SELECT r.id, r.origen, r.destino, CAST(s.viajes AS INTEGER) AS viajes,
+             s.km, s.ingreso, s.eur_km,
+             s.km / s.viajes AS km_medio,
+             s.km_vacio / s.viajes AS km_vacio_medio,
+             CASE WHEN s.viajes_con_horas > 0 THEN s.horas / s.viajes_con_horas END AS horas_media
+      FROM ruta_stats s
+      JOIN rutas r ON r.id = s.ruta_id
+      WHERE s.viajes > 0
+      ORDER BY {col} {"DESC" if desc else "ASC"}
+      LIMIT ?
+    """, (limit,))
+    return cur.fetchall()
+
+
+# -------------------------
+# Validación de registros (formularios y API)
+# -------------------------
+def fnum(x, default=0.0):
+    try:
+        return float(x) if x not in (None, "") else float(default)
+    except (TypeError, ValueError):
+        return float(default)
+
+
+def _txt(data, key, default=""):
+    v = data.get(key)
+    return default if v is None else str(v).strip()
+
+
+def parse_viaje(data):
+    """(fila, error) a partir de un form o un dict JSON. error = "" si es válido."""
+    camion_id = to_int_or_none(data.get("camion_id"))
+
+    # sin km_inicio: se continúa desde el último km del camión
+    km_inicio_default = 0
+    if camion_id is not None and data.get("km_inicio") in (None, ""):
+        estado = get_camion_estado(camion_id)
+        if estado and estado["ultimo_km"] is not None:
+            km_inicio_default = estado["ultimo_km"]
+
+    tipo_tramo = _txt(data, "tipo_tramo", "CARGADO").upper()
+    if tipo_tramo not in ("CARGADO", "VACIO"):
+        tipo_tramo = "CARGADO"
+
+    row = {
+        "fecha": _txt(data, "fecha"),
+        "origen": _txt(data, "origen"),
+        "destino": _txt(data, "destino"),
+        "km_inicio": fnum(data.get("km_inicio"), km_inicio_default),
+        "km_fin": fnum(data.get("km_fin"), 0),
+        "peso_kg": fnum(data.get("peso_kg"), 0),
+        "tipo_tramo": tipo_tramo,
+        "ingreso": fnum(data.get("ingreso"), 0),
+        "peajes": fnum(data.get("peajes"), 0),
+        "parking": fnum(data.get("parking"), 0),
+        "camion_id": camion_id,
+        "conductor_id": to_int_or_none(data.get("conductor_id")),
+        "duracion_h": fnum(data.get("duracion_h")) if data.get("duracion_h") not in (None, "") else None,
+    }
+
+    if not row["fecha"] or not row["origen"] or not row["destino"]:
+        return row, "Falta fecha/origen/destino."
+    if row["km_fin"] < row["km_inicio"]:
+        return row, "km_fin no puede ser menor que km_inicio."
+    return row, check_km_continuidad(camion_id, row["fecha"], row["km_inicio"])
+
+
+def parse_repostaje(data):
+    tipo = _txt(data, "tipo", "gasoil").lower()
+    if tipo not in ("gasoil", "adblue"):
+        tipo = "gasoil"
+
+    litros = fnum(data.get("litros"), 0)
+    precio_litro = fnum(data.get("precio_litro"), 0)
+
+    km_odo = None
+    if data.get("km_odometro") not in (None, ""):
+        try:
+            km_odo = float(data.get("km_odometro"))
+        except (TypeError, ValueError):
+            km_odo = None
+
+    row = {
+        "fecha": _txt(data, "fecha"),
+        "litros": litros,
+        "precio_litro": precio_litro,
+        "importe": fnum(data.get("importe"), litros * precio_litro),
+        "km_odometro": km_odo,
+        "estacion": _txt(data, "estacion"),
+        "tipo": tipo,
+        "conductor_id": to_int_or_none(data.get("conductor_id")),
+        "camion_id": to_int_or_none(data.get("camion_id")),
+        "lleno": 0 if _txt(data, "lleno", "1").lower() in ("0", "false", "no", "off") else 1,
+    }
+
+    if not row["fecha"]:
+        return row, "Falta la fecha."
+    if litros <= 0:
+        return row, "Litros debe ser mayor que 0."
+    if precio_litro <= 0:
+        return row, "Precio/L debe ser mayor que 0."
+    if row["importe"] <= 0:
+        return row, "Importe debe ser mayor que 0."
+    return row, ""
+
+
+def parse_tacografo(data):
+    row = {
+        "fecha": _txt(data, "fecha"),
+        "horas_conduccion": fnum(data.get("horas_conduccion"), 0),
+        "horas_disponibilidad": fnum(data.get("horas_disponibilidad"), 0),
+        "horas_descanso": fnum(data.get("horas_descanso"), 11),
+        "comentario": _txt(data, "comentario"),
+        "conductor_id": to_int_or_none(data.get("conductor_id")),
+    }
+    if not row["fecha"]:
+        return row, "Falta fecha."
+    for k in ("horas_conduccion", "horas_disponibilidad", "horas_descanso"):
+        if not 0 <= row[k] <= 24:
+            return row, f"{k} debe estar entre 0 y 24."
+    return row, ""
+
+
+# tabla -> funciones (cur, row) que completan la fila antes del INSERT
+BEFORE_INSERT_HOOKS = {
+    "viajes": [asignar_ruta],
+}
+
+# tabla -> funciones (cur, id) que se ejecutan en la misma transacción tras insertar
+AFTER_INSERT_HOOKS = {
+    "repostajes": [actualizar_consumo],
+}
+
+
+def insert_row(cur, table, row):
+    for hook in BEFORE_INSERT_HOOKS.get(table, []):
+        hook(cur, row)
+    cols = list(row)
+    cur.execute(
+        f"INSERT INTO {table}({', '.join(cols)}) VALUES({', '.join('?' for _ in cols)})",
+        [row[c] for c in cols]
+    )
+    new_id = cur.lastrowid
+    for hook in AFTER_INSERT_HOOKS.get(table, []):
+        hook(cur, new_id)
+    return new_id
+
+
+# -------------------------
+# Sesiones en servidor
+# -------------------------
+# SESSION_DB: SQLite compartido por todos los workers y empresas (None = cookie firmada de Flask)
+SESSION_DB = "sesiones.db"
+SESSION_IDLE = 8 * 3600          # segundos sin uso hasta que caduca
+SESSION_TOUCH_INTERVAL = 60      # cada cuánto se persiste ultimo_uso si la sesión no cambia
+SESSION_LRU_SIZE = 5000
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self_):
+            self_.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.sid_anterior = None
+        self.guardada = 0.0
+        self.version = None
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    La cookie solo lleva un id aleatorio; los datos (user_id, empresa, instantánea del
+    usuario) viven en la tabla sesiones, con un LRU en memoria delante.
+    Revocar una sesión sube sesiones_revocacion.version: cada request compara ese
+    contador (una fila) y, si cambió, vacía el LRU, así la revocación vale al momento
+    en todos los workers sin tocar users.
+    Cada sesión recuerda la versión con la que se abrió: si cambió antes de guardarla,
+    no vuelve al LRU (un request en vuelo no resucita una sesión recién revocada).
+    """
+    serializer = session_json_serializer
+
+    def __init__(self, path_fn, lru_size=SESSION_LRU_SIZE):
+        self._path_fn = path_fn
+        self._pool = None
+        self._lru = OrderedDict()
+        self._lru_size = lru_size
+        self._version = None
+        self._lock = threading.Lock()
+
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    pool = ConnectionPool(self._path_fn(), size=4)
+                    conn = pool.acquire()
+                    try:
+                        conn.execute("""
+                        CREATE TABLE IF NOT EXISTS sesiones (
+                          id TEXT PRIMARY KEY,
+                          empresa TEXT,
+                          user_id INTEGER,
+                          datos TEXT NOT NULL,
+                          ultimo_uso REAL NOT NULL,
+                          revocada INTEGER NOT NULL DEFAULT 0
+                        )
+                        """)
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_user ON sesiones(empresa, user_id)")
+                        conn.execute("CREATE TABLE IF NOT EXISTS sesiones_revocacion (id INTEGER PRIMARY KEY CHECK(id=1), version INTEGER NOT NULL)")
+                        conn.execute("INSERT OR IGNORE INTO sesiones_revocacion(id, version) VALUES(1, 0)")
+                        conn.commit()
+                    finally:
+                        pool.release(conn)
+                    self._pool = pool
+        return self._pool
+
+    def _run(self, fn):
+        pool = self.pool()
+        conn = pool.acquire()
+        try:
+            rv = fn(conn)
+            conn.commit()
+            return rv
+        finally:
+            pool.release(conn)
+
+    def _lru_put(self, sid, entry, version):
+        with self._lock:
+            if version != self._version:
+                return
+            self._lru[sid] = entry
+            self._lru.move_to_end(sid)
+            while len(self._lru) > self._lru_size:
+                self._lru.popitem(last=False)
+
+    def _lru_pop(self, sid):
+        with self._lock:
+            self._lru.pop(sid, None)
+
+    def _cargar(self, conn, sid):
+        version = conn.execute("SELECT version FROM sesiones_revocacion WHERE id=1").fetchone()[0]
+        with self._lock:
+            if version != self._version:
+                self._lru.clear()
+                self._version = version
+            entry = self._lru.get(sid)
+            if entry is not None:
+                self._lru.move_to_end(sid)
+                return version, entry
+        row = conn.execute(
+            "SELECT datos, ultimo_uso FROM sesiones WHERE id=? AND revocada=0", (sid,)
+        ).fetchone()
+        if row is None:
+            return version, None
+        entry = {"datos": self.serializer.loads(row["datos"]), "ultimo_uso": row["ultimo_uso"]}
+        self._lru_put(sid, entry, version)
+        return version, entry
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            version, entry = self._run(lambda conn: self._cargar(conn, sid))
+            if entry is not None:
+                if time.time() - entry["ultimo_uso"] <= SESSION_IDLE:
+                    sess = ServerSession(dict(entry["datos"]), sid=sid)
+                    sess.guardada = entry["ultimo_uso"]
+                    sess.version = version
+                    return sess
+                self._borrar(sid)
+        sess = ServerSession(sid=secrets.token_urlsafe(32), new=True)
+        with self._lock:
+            sess.version = self._version
+        return sess
+
+    def _borrar(self, sid):
+        self._lru_pop(sid)
+        self._run(lambda conn: conn.execute("DELETE FROM sesiones WHERE id=?", (sid,)))
+
+    def save_session(self, app, sess, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if sess.sid_anterior:
+            self._borrar(sess.sid_anterior)
+
+        if not sess:
+            if not sess.new:
+                self._borrar(sess.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        if sess.modified or sess.new:
+            datos = dict(sess)
+            self._run(lambda conn: conn.execute("""
+              INSERT INTO sesiones(id, empresa, user_id, datos, ultimo_uso) VALUES(?,?,?,?,?)
+              ON CONFLICT(id) DO UPDATE SET empresa=excluded.empresa, user_id=excluded.user_id,
+                datos=excluded.datos, ultimo_uso=excluded.ultimo_uso
+            """, (sess.sid, datos.get("empresa"), datos.get("user_id"), self.serializer.dumps(datos), now)))
+        elif now - sess.guardada > SESSION_TOUCH_INTERVAL:
+            self._run(lambda conn: conn.execute("UPDATE sesiones SET ultimo_uso=? WHERE id=?", (now, sess.sid)))
+        else:
+            now = sess.guardada
+        self._lru_put(sess.sid, {"datos": dict(sess), "ultimo_uso": now}, sess.version)
+
+        if sess.new or sess.modified or sess.sid_anterior:
+            response.set_cookie(
+                name, sess.sid,
+                httponly=self.get_cookie_httponly(app),
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+                domain=domain, path=path,
+            )
+
+    def _tocar_usuario(self, empresa, user_id, sql):
+        def fn(conn):
+            conn.execute(sql, (empresa, empresa, int(user_id)))
+            conn.execute("UPDATE sesiones_revocacion SET version=version+1 WHERE id=1")
+        self._run(fn)
+        with self._lock:
+            self._lru.clear()
+
+    def revocar_usuario(self, empresa, user_id):
+        self._tocar_usuario(empresa, user_id,
+                            "UPDATE sesiones SET revocada=1 WHERE (empresa=? OR (empresa IS NULL AND ? IS NULL)) AND user_id=?")
+
+    def refrescar_usuario(self, empresa, user_id):
+        """Quita la instantánea del usuario: se vuelve a leer de users en el siguiente request."""
+        self._tocar_usuario(empresa, user_id,
+                            "UPDATE sesiones SET datos=json_remove(datos, '$.user_snap') "
+                            "WHERE (empresa=? OR (empresa IS NULL AND ? IS NULL)) AND user_id=?")
+
+
+if SESSION_DB:
+    app.session_interface = SqliteSessionInterface(lambda: SESSION_DB)
+
+
+def regenerar_sesion():
+    """Nuevo id de sesión (al iniciar sesión, contra fijación de sesión)."""
+    if isinstance(session._get_current_object(), ServerSession):
+        session.sid_anterior = session.sid
+        session.sid = secrets.token_urlsafe(32)
+        session.modified = True
+
+
+# -------------------------
+# Auth helpers
+# -------------------------
+def _user_snapshot(u):
+    # "v": versión de users (tabla_version) con la que se leyó; cualquier cambio en users
+    # la sube, también desde otro worker o la CLI, y la instantánea deja de valer
+    return {
+        "id": u["id"], "username": u["username"], "role": u["role"],
+        "conductor_id": u["conductor_id"], "ts": time.time(), "v": tabla_versiones(("users",))[0],
+    }
+
+
+def invalidate_user(user_id):
+    """
+    Hook para cuando se desactiva/cambia un usuario: sube la versión de users en la BD,
+    así las instantáneas de sesión anteriores dejan de valer en todos los workers y se
+    vuelve a consultar la tabla.
+    """
+    conn = get_conn()
+    conn.execute("""
+      INSERT INTO tabla_version(tabla, version, modificado) VALUES('users', 1, CURRENT_TIMESTAMP)
+      ON CONFLICT(tabla) DO UPDATE SET version=version+1, modificado=CURRENT_TIMESTAMP
+    """)
+    conn.commit()
+    g.pop("tabla_estado", None)
+    if isinstance(app.session_interface, SqliteSessionInterface):
+        app.session_interface.refrescar_usuario(empresa_actual(), user_id)
+    if g.get("user") is not None and g.user["id"] == int(user_id):
+        g.pop("user")
+
+
+def deactivate_user(user_id):
+    conn = get_conn()
+    conn.execute("UPDATE users SET active=0 WHERE id=?", (user_id,))
+    conn.commit()
+    invalidate_user(user_id)
+    if isinstance(app.session_interface, SqliteSessionInterface):
+        app.session_interface.revocar_usuario(empresa_actual(), user_id)
+
+
+def _load_user(uid):
+    snap = session.get("user_snap")
+    # instantáneas de versiones anteriores (sin todas las claves) no valen
+    if USER_SNAPSHOT_TTL > 0 and snap and snap.get("id") == uid and "conductor_id" in snap:
+        ts = snap.get("ts") or 0
+        # en sesiones de servidor vale hasta que se revoca o se refresca (invalidate_user)
+        vigente = isinstance(session._get_current_object(), ServerSession) or time.time() - ts < USER_SNAPSHOT_TTL
+        if vigente and snap.get("v") == tabla_versiones(("users",))[0]:
+            return snap
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM users WHERE id=? AND active=1", (uid,))
+    u = cur.fetchone()
+    if not u:
+        session.pop("user_snap", None)
+        return None
+    if USER_SNAPSHOT_TTL > 0:
+        session["user_snap"] = _user_snapshot(u)
+    return u
+
+
+def current_user():
+    """
+    Usuario del request, resuelto una sola vez y guardado en flask.g.
+    Con USER_SNAPSHOT_TTL > 0 se reutiliza la instantánea firmada de la sesión
+    y no se toca la tabla users hasta que caduca o se invalida.
+    """
+    if "user" in g:
+        return g.user
+    uid = session.get("user_id")
+    # una sesión iniciada en otra empresa (otro subdominio) no vale aquí
+    if uid and session.get("empresa") != empresa_actual():
+        uid = None
+    g.user = _load_user(uid) if uid else None
+    return g.user
+
+
+def login_required(fn):
+    def wrapper(*args, **kwargs):
+        if not current_user():
+            return redirect(url_for("login"))
+        return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+
+def manager_required(fn):
+    def wrapper(*args, **kwargs):
+        u = current_user()
+        if not u:
+            return redirect(url_for("login"))
+        if u["role"] != "manager":
+            return abort(403)
+        return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+
+# -------------------------
+# PINs y límite de intentos de login
+# -------------------------
+# Coste del hash: con PINs de 4 cifras el hash no aguanta un volcado de la BD;
+# lo que frena la fuerza bruta es el limitador. El coste fija la latencia de cada login.
+PIN_HASH_METHOD = "pbkdf2:sha256:100000"
+# fallos permitidos por ventana deslizante (segundos) antes de bloquear
+LOGIN_LIMITES = {
+    "usuario": (5, 300),
+    "ip": (30, 300),
+}
+# None = contador en memoria (por proceso); una ruta = SQLite compartido entre workers
+LOGIN_LIMITER_DB = None
+
+_pin_dummy_hash = None
+
+
+def hash_pin(pin):
+    return generate_password_hash(str(pin), method=PIN_HASH_METHOD)
+
+
+def check_pin(u, pin):
+    """
+    Compara el PIN con el hash del usuario. Si no hay usuario se compara con un hash
+    falso del mismo coste: la respuesta tarda lo mismo exista o no el usuario.
+    """
+    global _pin_dummy_hash
+    if u is None or not u["pin_hash"]:
+        if _pin_dummy_hash is None:
+            _pin_dummy_hash = hash_pin("0000")
+        check_password_hash(_pin_dummy_hash, pin)
+        return False
+    return check_password_hash(u["pin_hash"], pin)
+
+
+def set_pin(cur, user_id, pin):
+    cur.execute("UPDATE users SET pin_hash=?, pin='' WHERE id=?", (hash_pin(pin), user_id))
+    invalidate_user(user_id)
+
+
+class SlidingWindowLimiter:
+    """
+    Fallos por clave en una ventana deslizante, en memoria del proceso.
+    Memoria acotada: las claves van en orden de último fallo, las caducadas se purgan
+    por delante en cada registro y, si aun así hay más de MAX_CLAVES, se descartan las
+    de fallo más antiguo. Cada clave guarda como mucho MAX_FALLOS_CLAVE fallos, más que
+    cualquier límite de LOGIN_LIMITES.
+    """
+
+    MAX_CLAVES = 10000
+    MAX_FALLOS_CLAVE = 100
+
+    def __init__(self):
+        self._fallos = OrderedDict()  # clave -> (ventana, deque de instantes)
+        self._lock = threading.Lock()
+
+    def _recientes(self, clave, ventana, now):
+        entry = self._fallos.get(clave)
+        if entry is None:
+            return 0
+        q = entry[1]
+        while q and q[0] <= now - ventana:
+            q.popleft()
+        if not q:
+            del self._fallos[clave]
+            return 0
+        return len(q)
+
+    def _purgar(self, now):
+        while self._fallos:
+            ventana, q = next(iter(self._fallos.values()))
+            if q and q[-1] > now - ventana:
+                break
+            self._fallos.popitem(last=False)
+        while len(self._fallos) > self.MAX_CLAVES:
+            self._fallos.popitem(last=False)
+
+    def fallos(self, clave, ventana):
+        with self._lock:
+            return self._recientes(clave, ventana, time.time())
+
+    def registrar(self, clave, ventana):
+        now = time.time()
+        with self._lock:
+            entry = self._fallos.pop(clave, None)
+            q = entry[1] if entry else deque(maxlen=self.MAX_FALLOS_CLAVE)
+            q.append(now)
+            self._fallos[clave] = (ventana, q)
+            self._purgar(now)
+            return self._recientes(clave, ventana, now)
+
+    def reset(self, clave):
+        with self._lock:
+            self._fallos.pop(clave, None)
+
+
+class SqliteWindowLimiter:
+    """
+    Mismo interfaz, con los fallos en un SQLite compartido por todos los workers.
+    Tabla acotada como la versión en memoria: cada registro recorta la clave a
+    MAX_FALLOS_CLAVE filas y, como mucho cada PURGA_CADA segundos, se borran los fallos
+    más viejos que la mayor ventana usada y, si aun así hay más de MAX_FILAS, los más antiguos.
+    """
+
+    MAX_FILAS = SlidingWindowLimiter.MAX_CLAVES * 10
+    MAX_FALLOS_CLAVE = SlidingWindowLimiter.MAX_FALLOS_CLAVE
+    PURGA_CADA = 60
+
+    def __init__(self, path):
+        self.pool = ConnectionPool(path, size=2)
+        self._ventana_max = 0
+        self._purgado = 0.0
+        conn = self.pool.acquire()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS login_fallos (clave TEXT NOT NULL, ts REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_login_fallos ON login_fallos(clave, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_login_fallos_ts ON login_fallos(ts)")
+            conn.commit()
+        finally:
+            self.pool.release(conn)
+
+    def _run(self, fn):
+        conn = self.pool.acquire()
+        try:
+            rv = fn(conn)
+            conn.commit()
+            return rv
+        finally:
+            self.pool.release(conn)
+
+    def fallos(self, clave, ventana):
+        return self._run(lambda c: c.execute(
+            "SELECT COUNT(*) FROM login_fallos WHERE clave=? AND ts > ?", (clave, time.time() - ventana)
+        ).fetchone()[0])
+
+    def _purgar(self, c, now):
+        # claves que no vuelven a fallar: sin esto sus filas no se borrarían nunca
+        c.execute("DELETE FROM login_fallos WHERE ts <= ?", (now - self._ventana_max,))
+        c.execute("""
+          DELETE FROM login_fallos WHERE ts <= (
+            SELECT ts FROM login_fallos ORDER BY ts DESC LIMIT 1 OFFSET ?
+          )
+        """, (self.MAX_FILAS,))
+
+    def registrar(self, clave, ventana):
+        def fn(c):
+            now = time.time()
+            self._ventana_max = max(self._ventana_max, ventana)
+            if now - self._purgado >= self.PURGA_CADA:
+                self._purgado = now
+                self._purgar(c, now)
+            c.execute("DELETE FROM login_fallos WHERE clave=? AND ts <= ?", (clave, now - ventana))
+            c.execute("INSERT INTO login_fallos(clave, ts) VALUES(?,?)", (clave, now))
+            c.execute("""
+              DELETE FROM login_fallos WHERE clave=? AND ts <= (
+                SELECT ts FROM login_fallos WHERE clave=? ORDER BY ts DESC LIMIT 1 OFFSET ?
+              )
+            """, (clave, clave, self.MAX_FALLOS_CLAVE))
+            return c.execute("SELECT COUNT(*) FROM login_fallos WHERE clave=?", (clave,)).fetchone()[0]
+        return self._run(fn)
+
+    def reset(self, clave):
+        self._run(lambda c: c.execute("DELETE FROM login_fallos WHERE clave=?", (clave,)))
+
+
+_login_limiter = None
+
+
+def login_limiter():
+    global _login_limiter
+    if _login_limiter is None:
+        _login_limiter = SqliteWindowLimiter(LOGIN_LIMITER_DB) if LOGIN_LIMITER_DB else SlidingWindowLimiter()
+    return _login_limiter
+
+
+def _login_claves(username):
+    return {
+        "usuario": f"usuario:{empresa_actual() or ''}:{username.lower()}",
+        "ip": f"ip:{request.remote_addr}",
+    }
+
+
+def login_bloqueado(username):
+    lim = login_limiter()
+    return any(
+        lim.fallos(clave, LOGIN_LIMITES[tipo][1]) >= LOGIN_LIMITES[tipo][0]
+        for tipo, clave in _login_claves(username).items()
+    )
+
+
+def login_fallido(username):
+    """Cuenta el fallo; al llegar justo al límite deja constancia del bloqueo."""
+    lim = login_limiter()
+    for tipo, clave in _login_claves(username).items():
+        maximo, ventana = LOGIN_LIMITES[tipo]
+        if lim.registrar(clave, ventana) == maximo:
+            app.logger.warning("login bloqueado: %s (%s intentos en %ss)", clave, maximo, ventana)
+            conn = get_conn()
+            conn.execute(
+                "INSERT INTO login_bloqueos(clave, username, ip) VALUES(?,?,?)",
+                (clave, username, request.remote_addr)
+            )
+            conn.commit()
+
+
+# -------------------------
+# Login / Logout
+# -------------------------
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    error = ""
+    status = 200
+    if request.method == "POST":
+        username = (request.form.get("username") or "").strip()
+        pin = (request.form.get("pin") or "").strip()
+
+        if EMPRESAS_MODO == "usuario":
+            empresa = (request.form.get("empresa") or "").strip().lower() or None
+            if empresa is not None and (not _EMPRESA_RE.match(empresa) or not os.path.exists(empresa_db_path(empresa))):
+                return render_template(
+                    "pages/login.html", hide_layout=True, body_class="login-v2",
+                    error="Empresa desconocida.", pedir_empresa=True
+                )
+            g.empresa = empresa
+
+        # bloqueado: se responde sin calcular el hash, así el ataque no consume CPU
+        if login_bloqueado(username):
+            error = "Demasiados intentos. Espere unos minutos."
+            status = 429
+        else:
+            cur = get_conn().cursor()
+            cur.execute("SELECT * FROM users WHERE username=? AND active=1", (username,))
+            u = cur.fetchone()
+
+            if check_pin(u, pin):
+                login_limiter().reset(_login_claves(username)["usuario"])
+                regenerar_sesion()
+                session["empresa"] = empresa_actual()
+                session["user_id"] = u["id"]
+                if USER_SNAPSHOT_TTL > 0:
+                    session["user_snap"] = _user_snapshot(u)
+                return redirect(url_for("dashboard"))
+            login_fallido(username)
+            error = "Usuario o PIN incorrecto."
+
+    return render_template(
+        "pages/login.html",
+        hide_layout=True,
+        body_class="login-v2",
+        error=error,
+        pedir_empresa=EMPRESAS_MODO == "usuario"
+    ), status
+
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect(url_for("login"))
+
+
+# -------------------------
+# Dashboard
+# -------------------------
+@app.route("/")
+@login_required
+def index():
+    return redirect(url_for("dashboard"))
+
+
+@app.route("/dashboard")
+@login_required
+@conditional_get("viajes", "repostajes", "tacografo", "settings")
+def dashboard():
+    u = current_user()
+
+    mes = (request.args.get("mes") or date.today().isoformat()[:7]).strip()
+
+    total = kpis_mes()
+    kpi = kpis_mes(mes)
+
+    fijo_km = coste_fijo_por_km()
+    costes_mes = kpi["gasoil_importe"] + kpi["peajes"] + kpi["parking"] + fijo_km * kpi["km"]
+    beneficio = kpi["ingresos"] - costes_mes
+
+    return render_template(
+        "pages/dashboard.html",
+        user=u,
+        active_page="dashboard",
+        page_title="Panel de Gestión",
+        page_subtitle=f"Resumen general · {date.today().isoformat()}",
+        mes=mes,
+        kpi=kpi,
+        coste_fijo_km=fijo_km,
+        costes_mes=costes_mes,
+        beneficio=beneficio,
+        total_viajes=int(total["viajes"]),
+        km_total=total["km"],
+        gasoil_total=total["gasoil_importe"],
+        horas_conduccion=total["horas_conduccion"],
+    )
+
+
+# -------------------------
+# Uploads (almacén por hash + miniaturas en segundo plano)
+# -------------------------
+UPLOAD_ROOT = "uploads"
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_WORKERS = 2
+THUMB_SIZE = (320, 320)
+
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="uploads")
+
+
+def store_upload(file_storage):
+    """
+    Guarda el fichero por trozos calculando su sha256 y lo deja en
+    uploads/blobs/<aa>/<hash><ext>. Si ya existía (mismo contenido) no se duplica.
+    La miniatura se genera después en el pool de workers.
+    Devuelve la ruta relativa a UPLOAD_ROOT.
+    """
+    tmp_dir = os.path.join(UPLOAD_ROOT, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    h = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file_storage.stream.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = h.hexdigest()
+
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute("SELECT path FROM uploads WHERE hash=?", (digest,))
+        row = cur.fetchone()
+        if row:
+            return row["path"]
+
+        ext = os.path.splitext(file_storage.filename or "")[1].lower()
+        ext = ext if ext[1:].isalnum() and len(ext) <= 6 else ""
+        rel_path = f"blobs/{digest[:2]}/{digest}{ext}"
+        full_path = os.path.join(UPLOAD_ROOT, rel_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(tmp_path, full_path)
+        tmp_path = None
+
+        cur.execute(
+            "INSERT OR IGNORE INTO uploads(hash, path, size, mime, nombre_original) VALUES(?,?,?,?,?)",
+            (digest, rel_path, size, file_storage.mimetype, file_storage.filename)
+        )
+        conn.commit()
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _upload_executor.submit(make_thumbnail, digest, full_path, empresa_actual())
+    return rel_path
+
+
+def make_thumbnail(digest, full_path, empresa=None):
+    """Worker: miniatura JPEG en uploads/thumbs/<hash>.jpg (si hay Pillow y es imagen)."""
+    if Image is None:
+        return
+    rel_thumb = f"thumbs/{digest}.jpg"
+    try:
+        with Image.open(full_path) as img:
+            img.thumbnail(THUMB_SIZE)
+            os.makedirs(os.path.join(UPLOAD_ROOT, "thumbs"), exist_ok=True)
+            img.convert("RGB").save(os.path.join(UPLOAD_ROOT, rel_thumb), "JPEG", quality=70, optimize=True)
+    except Exception:
+        return  # PDF u otro formato: sin miniatura
+
+    # fuera de request: conexión directa del pool de la empresa
+    pool = empresa_pools.get(empresa)
+    conn = pool.acquire()
+    try:
+        conn.execute("UPDATE uploads SET thumb_path=? WHERE hash=?", (rel_thumb, digest))
+        conn.commit()
+    finally:
+        pool.release(conn)
+
+
+# -------------------------
+# Serve uploads (CMR / tickets)
+# -------------------------
+# Delegar el envío de bytes al servidor web: None, "x-sendfile" (Apache/lighttpd)
+# o "x-accel" (nginx, con un location internal en UPLOAD_ACCEL_PREFIX -> UPLOAD_ROOT)
+UPLOAD_SENDFILE = None
+UPLOAD_ACCEL_PREFIX = "/_uploads/"
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
+
+def _upload_etag(subpath):
+    """ETag fuerte a partir del hash del nombre (blobs/aa/<hash>.ext, thumbs/<hash>.jpg) o None."""
+    parts = subpath.split("/")
+    stem = os.path.splitext(parts[-1])[0]
+    if len(stem) != 64 or not all(ch in "0123456789abcdef" for ch in stem):
+        return None
+    if parts[0] == "blobs" and len(parts) == 3:
+        return stem
+    if parts[0] == "thumbs" and len(parts) == 2:
+        return stem + "-thumb"
+    return None
+
+
+@app.route("/uploads/<path:subpath>")
+@login_required
+def serve_upload(subpath):
+    full_path = safe_join(UPLOAD_ROOT, subpath)
+    if full_path is None:
+        abort(404)
+    etag = _upload_etag(subpath)
+
+    # los blobs se comparten entre empresas (mismo hash = mismo contenido),
+    # pero cada una solo ve los que constan en su tabla uploads
+    if empresa_actual() is not None:
+        cur = get_conn().cursor()
+        cur.execute("SELECT 1 FROM uploads WHERE hash=?", ((etag or "").removesuffix("-thumb"),))
+        if cur.fetchone() is None:
+            abort(404)
+
+    # contenido direccionado por hash: nunca cambia, basta con comparar el ETag
+    if etag and etag in request.if_none_match:
+        rv = Response(status=304)
+        rv.set_etag(etag)
+        rv.cache_control.private = True
+        rv.cache_control.max_age = UPLOAD_MAX_AGE
+        rv.cache_control.immutable = True
+        return rv
+
+    if not os.path.isfile(full_path):
+        abort(404)
+
+    if UPLOAD_SENDFILE == "x-accel":
+        rv = Response(mimetype=mimetypes.guess_type(full_path)[0] or "application/octet-stream")
+        rv.headers["X-Accel-Redirect"] = UPLOAD_ACCEL_PREFIX + subpath
+    else:
+        # conditional=True: atiende If-None-Match / If-Modified-Since y Range
+        rv = send_file(
+            full_path,
+            request.environ,
+            conditional=True,
+            etag=etag or True,
+            use_x_sendfile=UPLOAD_SENDFILE == "x-sendfile",
+        )
+
+    if etag:
+        rv.set_etag(etag)
+        rv.cache_control.no_cache = None
+        rv.cache_control.public = False
+        rv.cache_control.private = True
+        rv.cache_control.max_age = UPLOAD_MAX_AGE
+        rv.cache_control.immutable = True
+    return rv
+
+
+# -------------------------
+# Viajes
+# -------------------------
+@app.route("/api/camiones/<int:camion_id>/estado")
+@login_required
+def api_camion_estado(camion_id):
+    estado = get_camion_estado(camion_id)
+    if estado is None:
+        return jsonify({"camion_id": camion_id, "km_actual": None})
+    return jsonify(estado)
+
+
+@app.route("/viajes", methods=["GET", "POST"])
+@login_required
+@conditional_get("viajes", "camiones", "camion_estado", "conductores")
+def viajes():
+    u = current_user()
+    error = ""
+
+    if request.method == "POST":
+        row, error = parse_viaje(request.form)
+        if not error:
+            conn = get_conn()
+            insert_row(conn.cursor(), "viajes", row)
+            conn.commit()
+            return redirect(url_for("viajes"))
+
+    def build():
+        cur = get_conn().cursor()
+        cur.execute("""
+          SELECT c.id, c.matricula, e.ultimo_km, e.ubicacion
+          FROM camiones c
+          LEFT JOIN camion_estado e ON e.camion_id = c.id
+          ORDER BY c.matricula
+        """)
+        camiones_sel = cur.fetchall()
+        cur.execute("SELECT id, nombre FROM conductores ORDER BY nombre")
+        conductores_sel = cur.fetchall()
+
+        rows, pager = fetch_page(
+            cur,
+            """
+          SELECT
+            v.*,
+            COALESCE(v.km_fin - v.km_inicio, v.distancia_km, 0) AS km_total
+          FROM viajes v
+            """,
+            "v", fecha_col="fecha", fk_cols=("camion_id", "conductor_id")
+        )
+        return dict(
+            rows=rows,
+            pager=pager,
+            camiones=camiones_sel,
+            conductores=conductores_sel,
+            conductores_filtro=conductores_sel,
+            error=error
+        )
+
+    return render_listado(
+        "pages/viajes.html",
+        ("viajes", "camiones", "camion_estado", "conductores"),
+        dict(user=u, active_page="viajes", page_title="Viajes", page_subtitle="Registro operativo"),
+        build
+    )
+
+
+# -------------------------
+# Repostajes
+# -------------------------
+@app.route("/repostajes", methods=["GET", "POST"])
+@login_required
+@conditional_get("repostajes", "users", "camiones", "uploads")
+def repostajes():
+    u = current_user()
+    error = ""
+
+    if request.method == "POST":
+        row, error = parse_repostaje(request.form)
+
+        if not error:
+            # ticket upload (opcional)
+            ticket_file = request.files.get("ticket_file")
+            if ticket_file and ticket_file.filename:
+                row["ticket_path"] = store_upload(ticket_file)
+            conn = get_conn()
+            insert_row(conn.cursor(), "repostajes", row)
+            conn.commit()
+            return redirect(url_for("repostajes"))
+
+    def build():
+        cur = get_conn().cursor()
+
+        # select chofer
+        cur.execute("SELECT id, username FROM users WHERE active=1 ORDER BY username")
+        conductores = cur.fetchall()
+
+        cur.execute("SELECT id, matricula FROM camiones ORDER BY matricula")
+        camiones_sel = cur.fetchall()
+
+        # tabla
+        rows, pager = fetch_page(
+            cur,
+            """
+          SELECT
+            r.*,
+            CASE WHEN r.litros > 0 THEN (r.importe / r.litros) ELSE 0 END AS precio_calc,
+            up.thumb_path AS ticket_thumb
+          FROM repostajes r
+          LEFT JOIN uploads up ON up.path = r.ticket_path
+            """,
+            "r", fecha_col="fecha", fk_cols=("camion_id", "conductor_id")
+        )
+        return dict(rows=rows, pager=pager, conductores=conductores, camiones=camiones_sel, error=error)
+
+    return render_listado(
+        "pages/repostajes.html",
+        ("repostajes", "users", "camiones", "uploads"),
+        dict(user=u, active_page="repostajes", page_title="Repostajes", page_subtitle="Registro de combustible"),
+        build
+    )
+
+
+# -------------------------
+# Tacógrafo
+# -------------------------
+@app.route("/tacografo", methods=["GET", "POST"])
+@login_required
+@conditional_get("tacografo", "conductores")
+def tacografo():
+    u = current_user()
+    msg = ""
+
+    if request.method == "POST":
+        row, msg = parse_tacografo(request.form)
+        if not msg:
+            conn = get_conn()
+            insert_row(conn.cursor(), "tacografo", row)
+            conn.commit()
+            return redirect(url_for("tacografo"))
+
+    def build():
+        cur = get_conn().cursor()
+        cur.execute("SELECT id, nombre FROM conductores ORDER BY nombre")
+        conductores_sel = cur.fetchall()
+        rows, pager = fetch_page(
+            cur,
+            "SELECT t.*, d.nombre AS conductor FROM tacografo t LEFT JOIN conductores d ON d.id = t.conductor_id",
+            "t", fecha_col="fecha", fk_cols=("conductor_id",)
+        )
+        return dict(rows=rows, pager=pager, conductores=conductores_sel, conductores_filtro=conductores_sel, msg=msg)
+
+    return render_listado(
+        "pages/tacografo.html",
+        ("tacografo", "conductores"),
+        dict(user=u, active_page="tacografo", page_title="Tacógrafo", page_subtitle="Horas manuales"),
+        build
+    )
+
+
+@app.route("/api/tacografo/alertas")
+@login_required
+def api_tacografo_alertas():
+    conductor_id = to_int_or_none(request.args.get("conductor_id"))
+    desde = (request.args.get("desde") or "").strip() or None
+    return jsonify({"alertas": tacografo_alertas(conductor_id, desde)})
+
+
+@app.route("/api/tacografo/sesion", methods=["GET", "POST"])
+@login_required
+def api_tacografo_sesion():
+    """
+    Reloj de actividad del chófer. POST {"accion": "start"|"pause"|"stop", "actividad": ..., "ts": opcional}.
+    El conductor es el vinculado al usuario; un manager puede indicar "conductor_id".
+    """
+    u = current_user()
+    data = request.get_json(silent=True) or {}
+    conductor_id = u["conductor_id"]
+    if u["role"] == "manager":
+        conductor_id = to_int_or_none(data.get("conductor_id") or request.args.get("conductor_id")) or conductor_id
+    if conductor_id is None:
+        return jsonify({"error": "El usuario no tiene conductor asignado."}), 400
+
+    conn = get_conn()
+    cur = conn.cursor()
+    error = ""
+    if request.method == "POST":
+        ts = None
+        if data.get("ts"):
+            try:
+                ts = datetime.fromisoformat(str(data["ts"]))
+            except ValueError:
+                return jsonify({"error": "ts no válido."}), 400
+            ts = hora_local(ts)
+            if ts > datetime.now() + timedelta(minutes=5):
+                return jsonify({"error": "ts en el futuro."}), 400
+        _sesion, error = sesion_accion(
+            cur, conductor_id, _txt(data, "accion"), _txt(data, "actividad") or None, ts, u["id"]
+        )
+        if error:
+            conn.rollback()
+        else:
+            conn.commit()
+
+    abierta = sesion_abierta(cur, conductor_id)
+    cur.execute(
+        "SELECT horas_conduccion, horas_disponibilidad, horas_descanso FROM tacografo "
+        "WHERE conductor_id=? AND fecha=? AND origen='reloj'",
+        (conductor_id, date.today().isoformat())
+    )
+    hoy = cur.fetchone()
+    body = {
+        "conductor_id": conductor_id,
+        "sesion": dict(abierta) if abierta else None,
+        "hoy": dict(hoy) if hoy else {c: 0.0 for c in ACTIVIDADES.values()},
+    }
+    if error:
+        body["error"] = error
+        return jsonify(body), 400
+    return jsonify(body)
+
+
+# -------------------------
+# Consumo (manager)
+# -------------------------
+@app.route("/consumo")
+@manager_required
+def consumo():
+    u = current_user()
+    conn = get_conn()
+    cur = conn.cursor()
+    if consumo_refresh(cur):
+        conn.commit()
+    camion_id = to_int_or_none(request.args.get("camion_id"))
+    mensual = consumo_mensual(cur, camion_id=camion_id)
+    anomalias = consumo_anomalias(cur, camion_id)
+    return render_template(
+        "pages/consumo.html",
+        user=u,
+        active_page="consumo",
+        page_title="Consumo",
+        page_subtitle="L/100 km por camión (lleno a lleno)",
+        mensual=mensual,
+        anomalias=anomalias,
+        tolerancia=CONSUMO_TOLERANCIA,
+    )
+
+
+@app.route("/api/consumo/anomalias")
+@manager_required
+def api_consumo_anomalias():
+    conn = get_conn()
+    cur = conn.cursor()
+    if consumo_refresh(cur):
+        conn.commit()
+    rows = consumo_anomalias(cur, to_int_or_none(request.args.get("camion_id")))
+    return jsonify({"anomalias": [dict(r) for r in rows]})
+
+
+@app.route("/rentabilidad")
+@manager_required
+def rentabilidad():
+    u = current_user()
+    conn = get_conn()
+    cur = conn.cursor()
+    # consumo primero: sus tramos recalculados invalidan la rentabilidad de los viajes que solapan
+    if consumo_refresh(cur) + asignar_rutas_pendientes(cur) + rentabilidad_refresh(cur):
+        conn.commit()
+
+    orden = request.args.get("orden") or "margen"
+    desc = request.args.get("dir") == "desc"
+    desde = (request.args.get("desde") or "").strip() or None
+    hasta = (request.args.get("hasta") or "").strip() or None
+
+    return render_template(
+        "pages/rentabilidad.html",
         user=u,
-        active_page="repostajes",
-        page_title="Repostajes",
-        page_subtitle="Registro de combustible",
-        rows=rows,
-        conductores=conductores,
-        error=error
+        active_page="rentabilidad",
+        page_title="Rentabilidad",
+        page_subtitle="Margen por viaje y por ruta",
+        rows=rentabilidad_viajes(cur, orden, desc, desde, hasta),
+        rutas=rentabilidad_rutas(cur, desde, hasta),
+        orden=orden,
+        desc=desc,
+        desde=desde or "",
+        hasta=hasta or "",
     )
 
 
-# -------------------------
-# Tacógrafo
-# -------------------------
-@app.route("/tacografo", methods=["GET", "POST"])
-@login_required
-def tacografo():
-    u = current_user()
-    msg = ""
+@app.route("/api/rutas")
+@manager_required
+def api_rutas():
+    """Resumen por ruta normalizada: viajes, €/km, km medios en vacío y duración media."""
+    orden = request.args.get("orden") or "eur_km"
+    desc = request.args.get("dir") == "desc"
+    limit = min(to_int_or_none(request.args.get("limit")) or PAGE_SIZE, PAGE_SIZE_MAX)
+    conn = get_conn()
+    cur = conn.cursor()
+    if asignar_rutas_pendientes(cur):
+        conn.commit()
+    rows = rutas_resumen(cur, orden, desc, limit)
+    return jsonify({"rutas": [dict(r) for r in rows]})
 
-    if request.method == "POST":
-        fecha = (request.form.get("fecha") or "").strip()
 
-        def fnum(x, default=0.0):
-            try:
-                return float(x) if x not in (None, "") else float(default)
-            except:
-                return float(default)
+# -------------------------
+# API por lotes (JSON)
+# -------------------------
+LOTE_MAX_ITEMS = 1000
+LOTE_PARSERS = {
+    "viajes": parse_viaje,
+    "repostajes": parse_repostaje,
+    "tacografo": parse_tacografo,
+}
 
-        horas_conduccion = fnum(request.form.get("horas_conduccion"), 0)
-        horas_disponibilidad = fnum(request.form.get("horas_disponibilidad"), 0)
-        horas_descanso = fnum(request.form.get("horas_descanso"), 11)
-        comentario = (request.form.get("comentario") or "").strip()
 
-        if not fecha:
-            msg = "Falta fecha."
-        else:
-            conn = get_conn()
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO tacografo(fecha,horas_conduccion,horas_disponibilidad,horas_descanso,comentario) VALUES(?,?,?,?,?)",
-                (fecha, horas_conduccion, horas_disponibilidad, horas_descanso, comentario)
-            )
-            conn.commit()
-            conn.close()
-            return redirect(url_for("tacografo"))
+@app.route("/api/<any(viajes, repostajes, tacografo):tabla>/lote", methods=["POST"])
+@login_required
+def api_lote(tabla):
+    """
+    Alta de muchos registros en una transacción. Body: lista de objetos o {"items": [...]}.
+    Cada objeto se valida igual que el formulario; con "idempotency_key" un reintento
+    devuelve el registro ya creado en vez de duplicarlo.
+    Respuesta: un resultado por item (created / duplicate / error) en el mismo orden.
+    """
+    payload = request.get_json(silent=True)
+    items = payload.get("items") if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        return jsonify({"error": "Se espera una lista de registros."}), 400
+    if len(items) > LOTE_MAX_ITEMS:
+        return jsonify({"error": f"Máximo {LOTE_MAX_ITEMS} registros por lote."}), 413
 
+    parser = LOTE_PARSERS[tabla]
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM tacografo ORDER BY id DESC LIMIT 200")
-    rows = cur.fetchall()
-    conn.close()
+    results = []
+    try:
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                results.append({"index": i, "status": "error", "error": "Registro no válido."})
+                continue
 
-    return render_template(
-        "pages/tacografo.html",
-        user=u,
-        active_page="tacografo",
-        page_title="Tacógrafo",
-        page_subtitle="Horas manuales",
-        rows=rows,
-        msg=msg
-    )
+            key = _txt(item, "idempotency_key")
+            if key:
+                cur.execute("SELECT registro_id FROM idempotencia WHERE tabla=? AND clave=?", (tabla, key))
+                prev = cur.fetchone()
+                if prev:
+                    results.append({"index": i, "status": "duplicate", "id": prev["registro_id"]})
+                    continue
+
+            row, error = parser(item)
+            if error:
+                results.append({"index": i, "status": "error", "error": error})
+                continue
+
+            new_id = insert_row(cur, tabla, row)
+            if key:
+                cur.execute(
+                    "INSERT INTO idempotencia(tabla, clave, registro_id) VALUES(?,?,?)",
+                    (tabla, key, new_id)
+                )
+            results.append({"index": i, "status": "created", "id": new_id})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    counts = {st: sum(1 for r in results if r["status"] == st) for st in ("created", "duplicate", "error")}
+    return jsonify({"tabla": tabla, **counts, "results": results})
 
 
 # -------------------------
@@ -471,6 +3768,7 @@ def tacografo():
 # -------------------------
 @app.route("/camiones", methods=["GET", "POST"])
 @manager_required
+@conditional_get("camiones")
 def camiones():
     u = current_user()
     error = ""
@@ -488,29 +3786,24 @@ def camiones():
                 conn.commit()
             except sqlite3.IntegrityError:
                 error = "Esa matrícula ya existe."
-            conn.close()
             if not error:
                 return redirect(url_for("camiones"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM camiones ORDER BY id DESC LIMIT 200")
-    rows = cur.fetchall()
-    conn.close()
+    def build():
+        rows, pager = fetch_page(get_conn().cursor(), "SELECT c.* FROM camiones c", "c")
+        return dict(rows=rows, pager=pager, error=error)
 
-    return render_template(
+    return render_listado(
         "pages/camiones.html",
-        user=u,
-        active_page="camiones",
-        page_title="Camiones",
-        page_subtitle="Gestión de flota",
-        rows=rows,
-        error=error
+        ("camiones",),
+        dict(user=u, active_page="camiones", page_title="Camiones", page_subtitle="Gestión de flota"),
+        build
     )
 
 
 @app.route("/conductores", methods=["GET", "POST"])
 @manager_required
+@conditional_get("conductores")
 def conductores():
     u = current_user()
     error = ""
@@ -526,41 +3819,1039 @@ def conductores():
             cur = conn.cursor()
             cur.execute("INSERT INTO conductores(nombre,dni,telefono) VALUES(?,?,?)", (nombre, dni, telefono))
             conn.commit()
-            conn.close()
             return redirect(url_for("conductores"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM conductores ORDER BY id DESC LIMIT 200")
-    rows = cur.fetchall()
-    conn.close()
+    def build():
+        rows, pager = fetch_page(get_conn().cursor(), "SELECT c.* FROM conductores c", "c")
+        return dict(rows=rows, pager=pager, error=error)
 
-    return render_template(
+    return render_listado(
         "pages/conductores.html",
-        user=u,
-        active_page="conductores",
-        page_title="Conductores",
-        page_subtitle="Alta y gestión",
-        rows=rows,
-        error=error
+        ("conductores",),
+        dict(user=u, active_page="conductores", page_title="Conductores", page_subtitle="Alta y gestión"),
+        build
     )
 
 
-@app.route("/ajustes", methods=["GET"])
+@app.route("/ajustes", methods=["GET", "POST"])
 @manager_required
 def ajustes():
     u = current_user()
+    error = ""
+
+    if request.method == "POST":
+        values = {}
+        for key in SETTINGS_DEFAULTS:
+            raw = (request.form.get(key) or "").strip().replace(",", ".")
+            if raw == "":
+                continue
+            try:
+                values[key] = float(raw)
+            except ValueError:
+                error = f"Valor no válido en {SETTINGS_DEFAULTS[key][1]}."
+                break
+        if not error:
+            set_settings(values)
+            return redirect(url_for("ajustes"))
+
+    settings = [(k, label, get_setting(k)) for k, (_d, label) in SETTINGS_DEFAULTS.items()]
+
     return render_template(
         "pages/ajustes.html",
         user=u,
         active_page="ajustes",
         page_title="Ajustes",
-        page_subtitle="Parámetros de la empresa"
+        page_subtitle="Parámetros de la empresa",
+        settings=settings,
+        coste_fijo_mes=coste_fijo_total_mes(),
+        coste_fijo_km=coste_fijo_por_km(),
+        gasoil_est=gasoil_estimado_mes(),
+        error=error
+    )
+
+
+# -------------------------
+# Export CSV (manager)
+# -------------------------
+EXPORT_BATCH = 1000
+
+# tabla -> (SELECT con alias "t", columna de fecha para ?desde/?hasta)
+EXPORTS = {
+    "viajes": ("""
+      SELECT t.id, t.fecha, t.tipo_tramo, t.origen, t.destino, t.peso_kg, t.ingreso,
+             t.km_inicio, t.km_fin, t.distancia_km, t.peajes, t.parking,
+             c.matricula AS camion, d.nombre AS conductor
+      FROM viajes t
+      LEFT JOIN camiones c ON c.id=t.camion_id
+      LEFT JOIN conductores d ON d.id=t.conductor_id
+    """, "fecha"),
+    "repostajes": ("""
+      SELECT t.id, t.fecha, t.tipo, t.litros, t.precio_litro, t.importe, t.km_odometro, t.estacion,
+             c.matricula AS camion, t.conductor_id, t.ticket_path
+      FROM repostajes t
+      LEFT JOIN camiones c ON c.id=t.camion_id
+    """, "fecha"),
+    "tacografo": ("""
+      SELECT t.id, t.fecha, d.nombre AS conductor, t.horas_conduccion, t.horas_disponibilidad,
+             t.horas_descanso, t.comentario
+      FROM tacografo t
+      LEFT JOIN conductores d ON d.id=t.conductor_id
+    """, "fecha"),
+}
+
+
+def iter_csv(cur, batch=EXPORT_BATCH):
+    """
+    Genera el CSV por trozos: fetchmany + csv.writer sobre un único buffer que se vacía
+    en cada lote, así la memoria no crece con el número de filas.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([d[0] for d in cur.description])
+    # la cabecera va sola: un export sin filas sigue siendo un CSV válido
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate(0)
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+
+
+def iter_gzip(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> formato gzip
+    for chunk in chunks:
+        data = z.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield z.flush()
+
+
+@app.route("/export_<any(viajes, repostajes, tacografo):tabla>.csv")
+@manager_required
+def export_csv(tabla):
+    select_sql, fecha_col = EXPORTS[tabla]
+    where, params = [], []
+    desde = (request.args.get("desde") or "").strip()
+    hasta = (request.args.get("hasta") or "").strip()
+    if desde:
+        where.append(f"t.{fecha_col} >= ?")
+        params.append(desde)
+    if hasta:
+        where.append(f"t.{fecha_col} < date(?, '+1 day')")
+        params.append(hasta)
+
+    sql = select_sql + (" WHERE " + " AND ".join(where) if where else "")
+    # orden por el índice de fecha: se recorre sin ordenar en memoria
+    sql += f" ORDER BY t.{fecha_col}, t.id"
+    cur = get_conn().cursor()
+    cur.execute(sql, params)
+
+    body = iter_csv(cur)
+    headers = {
+        "Content-Disposition": f"attachment; filename={tabla}.csv",
+        "Vary": "Accept-Encoding",
+    }
+    # calidad > 0: "gzip;q=0" significa que el cliente lo rechaza
+    if request.accept_encodings["gzip"] > 0:
+        body = iter_gzip(body)
+        headers["Content-Encoding"] = "gzip"
+
+    # stream_with_context: la conexión del pool sigue viva hasta terminar de enviar
+    return Response(stream_with_context(body), mimetype="text/csv", headers=headers)
+
+
+# -------------------------
+# Import CSV (herramienta antigua)
+# -------------------------
+IMPORT_BATCH = 5000
+
+
+def _num(row, key, default=0.0):
+    v = (row.get(key) or "").strip()
+    if v == "":
+        return float(default)
+    try:
+        return float(v.replace(",", "."))
+    except ValueError:
+        raise ValueError(f"{key} no numérico: {v!r}")
+
+
+def _fecha(row, key="fecha"):
+    v = (row.get(key) or "").strip()
+    try:
+        return date.fromisoformat(v[:10]).isoformat()
+    except ValueError:
+        raise ValueError(f"{key} inválida: {v!r}")
+
+
+def _map_viaje(row):
+    origen = (row.get("origen") or "").strip()
+    destino = (row.get("destino") or "").strip()
+    if not origen or not destino:
+        raise ValueError("falta origen/destino")
+    # la herramienta antigua no guardaba odómetro, solo la distancia: km_inicio/km_fin quedan NULL
+    distancia = _num(row, "distancia")
+    if distancia < 0:
+        raise ValueError("distancia negativa")
+    return (
+        _fecha(row), origen, destino, distancia,
+        _num(row, "ingreso"), _num(row, "peajes"),
+        to_int_or_none(row.get("camion_id")), to_int_or_none(row.get("conductor_id")),
+    )
+
+
+def _map_camion(row):
+    matricula = (row.get("matricula") or "").strip().upper()
+    if not matricula:
+        raise ValueError("falta matrícula")
+    return (to_int_or_none(row.get("id")), matricula, (row.get("nombre") or row.get("descripcion") or "").strip())
+
+
+def _map_conductor(row):
+    nombre = (row.get("nombre") or "").strip()
+    if not nombre:
+        raise ValueError("falta nombre")
+    return (to_int_or_none(row.get("id")), nombre, (row.get("dni") or "").strip(), (row.get("telefono") or "").strip())
+
+
+def _map_tacografo(row):
+    conduccion = _num(row, "horas_conduccion")
+    descanso = _num(row, "horas_descanso", 11)
+    if not (0 <= conduccion <= 24 and 0 <= descanso <= 24):
+        raise ValueError("horas fuera de rango")
+    return (to_int_or_none(row.get("conductor_id")), _fecha(row), conduccion,
+            _num(row, "horas_disponibilidad"), descanso, (row.get("comentario") or "").strip())
+
+
+def _map_tacografo_sesion(row):
+    # formato reloj start/stop: conductor_id,fecha,inicio,fin[,actividad]
+    # va a tacografo_sesiones como sesión cerrada; el descanso que no esté en el fichero
+    # queda sin registrar, igual que en el reloj
+    conductor_id = to_int_or_none(row.get("conductor_id"))
+    if conductor_id is None:
+        raise ValueError("falta conductor_id")
+    actividad = (row.get("actividad") or "conduccion").strip().lower()
+    if actividad not in ACTIVIDADES:
+        raise ValueError(f"actividad no válida: {actividad!r}")
+    try:
+        inicio = hora_local(datetime.fromisoformat((row.get("inicio") or "").strip()))
+        fin = hora_local(datetime.fromisoformat((row.get("fin") or "").strip()))
+    except ValueError:
+        raise ValueError("inicio/fin inválidos")
+    if fin < inicio:
+        raise ValueError("fin anterior a inicio")
+    return (conductor_id, actividad, inicio.isoformat(timespec="seconds"), fin.isoformat(timespec="seconds"))
+
+
+def sumar_sesiones_importadas(cur, desde_id):
+    """Lleva a las filas diarias del reloj las sesiones importadas (id > desde_id)."""
+    cur.execute(
+        "SELECT conductor_id, actividad, inicio, fin FROM tacografo_sesiones WHERE id > ? ORDER BY id",
+        (desde_id,)
+    )
+    for r in cur.fetchall():
+        sumar_sesion(cur, r["conductor_id"], r["actividad"],
+                     datetime.fromisoformat(r["inicio"]), datetime.fromisoformat(r["fin"]))
+
+
+# tipo -> (columnas que lo identifican, mapper, INSERT, columnas extra de filas irregulares)
+IMPORTS = {
+    "viajes": (
+        {"fecha", "origen", "destino"}, _map_viaje,
+        "INSERT INTO viajes(fecha, origen, destino, distancia_km, ingreso, peajes, camion_id, conductor_id)"
+        " VALUES(?,?,?,?,?,?,?,?)",
+        ["camion_id", "conductor_id"],
+    ),
+    "camiones": (
+        {"matricula"}, _map_camion,
+        "INSERT INTO camiones(id, matricula, descripcion) VALUES(?,?,?)",
+        [],
+    ),
+    "conductores": (
+        {"nombre"}, _map_conductor,
+        "INSERT INTO conductores(id, nombre, dni, telefono) VALUES(?,?,?,?)",
+        [],
+    ),
+    "tacografo_sesiones": (
+        {"conductor_id", "fecha", "inicio", "fin"}, _map_tacografo_sesion,
+        "INSERT INTO tacografo_sesiones(conductor_id, actividad, inicio, fin) VALUES(?,?,?,?)",
+        [],
+    ),
+    "tacografo": (
+        {"fecha", "horas_conduccion"}, _map_tacografo,
+        "INSERT INTO tacografo(conductor_id, fecha, horas_conduccion, horas_disponibilidad, horas_descanso, comentario)"
+        " VALUES(?,?,?,?,?,?)",
+        [],
+    ),
+}
+
+
+def detect_import_tipo(header):
+    cols = {h.strip().lower() for h in header}
+    # camiones antes que conductores (los dos tienen "nombre")
+    for tipo in ("viajes", "camiones", "tacografo_sesiones", "tacografo", "conductores"):
+        if IMPORTS[tipo][0] <= cols:
+            return tipo
+    return None
+
+
+def _motivo_integridad(e):
+    msg = str(e)
+    if msg.startswith("UNIQUE constraint failed: "):
+        return "ya existe (" + msg.split(": ", 1)[1] + ")"
+    return msg
+
+
+def _insertar_lote(cur, insert_sql, pending, rechazadas):
+    """
+    executemany del lote; si choca con una restricción (p. ej. un id antiguo que ya
+    está ocupado) se deshace el lote y se repite fila a fila para rechazar solo esas.
+    """
+    cur.execute("SAVEPOINT import_lote")
+    try:
+        cur.executemany(insert_sql, [values for _lineno, _raw, values in pending])
+        n = cur.rowcount
+    except sqlite3.IntegrityError:
+        cur.execute("ROLLBACK TO import_lote")
+        n = 0
+        for lineno, raw, values in pending:
+            try:
+                cur.execute(insert_sql, values)
+                n += 1
+            except sqlite3.IntegrityError as e:
+                rechazadas.append((lineno, _motivo_integridad(e), raw))
+    cur.execute("RELEASE import_lote")
+    return n
+
+
+def import_csv(conn, lines, tipo=None, batch=IMPORT_BATCH):
+    """
+    Importa un CSV de la herramienta antigua leyendo fila a fila.
+    Las filas válidas se insertan con executemany por lotes dentro de una sola
+    transacción; las inválidas, y las que chocan con filas existentes, se devuelven
+    en "rechazadas" (línea, motivo, fila).
+    """
+    reader = csv.reader(lines)
+    header = [h.strip().lower() for h in next(reader, [])]
+    tipo = tipo or detect_import_tipo(header)
+    if tipo not in IMPORTS:
+        raise ValueError("No se reconoce el formato del CSV.")
+    _, mapper, insert_sql, extra_cols = IMPORTS[tipo]
+
+    ok, rechazadas, pending = 0, [], []
+    cur = conn.cursor()
+    if not conn.in_transaction:
+        cur.execute("BEGIN")
+    try:
+        if tipo == "tacografo_sesiones":
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM tacografo_sesiones")
+            desde_id = cur.fetchone()[0]
+        for lineno, raw in enumerate(reader, start=2):
+            if not any(c.strip() for c in raw):
+                continue
+            if len(raw) < len(header):
+                rechazadas.append((lineno, "faltan columnas", raw))
+                continue
+            row = dict(zip(header, raw))
+            # filas con columnas de más: se interpretan como extra_cols si existen
+            for name, value in zip(extra_cols, raw[len(header):]):
+                row.setdefault(name, value)
+            if len(raw) > len(header) + len(extra_cols):
+                rechazadas.append((lineno, "columnas de más", raw))
+                continue
+            try:
+                pending.append((lineno, raw, mapper(row)))
+            except ValueError as e:
+                rechazadas.append((lineno, str(e), raw))
+                continue
+            if len(pending) >= batch:
+                ok += _insertar_lote(cur, insert_sql, pending, rechazadas)
+                pending = []
+        if pending:
+            ok += _insertar_lote(cur, insert_sql, pending, rechazadas)
+        if tipo == "viajes":
+            asignar_rutas_pendientes(cur)
+        elif tipo == "tacografo_sesiones":
+            sumar_sesiones_importadas(cur, desde_id)
+        rechazadas.sort(key=lambda r: r[0])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {"tipo": tipo, "importadas": ok, "rechazadas": rechazadas}
+
+
+@app.cli.command("importar")
+@click.argument("paths", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option("--tipo", type=click.Choice(sorted(IMPORTS)), default=None, help="Forzar formato (por defecto se detecta).")
+def importar_command(paths, tipo):
+    """Importa CSVs antiguos (viajes, camiones, conductores, tacógrafo)."""
+    conn = get_conn()
+    for path in paths:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            res = import_csv(conn, f, tipo=tipo)
+        click.echo(f"{path}: {res['tipo']} · {res['importadas']} importadas · {len(res['rechazadas'])} rechazadas")
+        if res["rechazadas"]:
+            rej_path = path + ".rechazos.csv"
+            with open(rej_path, "w", newline="", encoding="utf-8") as f:
+                w = csv.writer(f)
+                w.writerow(["linea", "motivo", "fila"])
+                for lineno, motivo, raw in res["rechazadas"]:
+                    w.writerow([lineno, motivo, ",".join(raw)])
+            click.echo(f"  rechazos -> {rej_path}")
+
+
+@app.route("/importar", methods=["POST"])
+@manager_required
+def importar():
+    f = request.files.get("file")
+    if not f or not f.filename:
+        return jsonify({"error": "Falta el fichero."}), 400
+    tipo = request.form.get("tipo") or None
+    lines = io.TextIOWrapper(f.stream, encoding="utf-8-sig", newline="")
+    try:
+        res = import_csv(get_conn(), lines, tipo=tipo)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    res["rechazadas"] = [{"linea": n, "motivo": m, "fila": raw} for n, m, raw in res["rechazadas"]]
+    return jsonify(res)
+
+
+@app.cli.command("crear-empresa")
+@click.argument("empresa")
+def crear_empresa_command(empresa):
+    """Crea la BD de EMPRESA en EMPRESAS_DIR y aplica init_db."""
+    empresa = empresa.strip().lower()
+    if not _EMPRESA_RE.match(empresa):
+        raise click.BadParameter("solo minúsculas, dígitos y guiones", param_hint="EMPRESA")
+    empresa_pools.get(empresa, crear=True)
+    click.echo(f"empresa {empresa}: {empresa_db_path(empresa)}")
+
+
+@app.cli.command("cambiar-pin")
+@click.argument("username")
+@click.password_option("--pin", prompt="PIN nuevo")
+def cambiar_pin_command(username, pin):
+    """Guarda el PIN de USERNAME con hash."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username=?", (username,))
+    u = cur.fetchone()
+    if not u:
+        raise click.ClickException(f"No existe el usuario {username}.")
+    set_pin(cur, u["id"], pin)
+    conn.commit()
+    click.echo(f"PIN de {username} actualizado.")
+
+
+@app.cli.command("desactivar-usuario")
+@click.argument("username")
+def desactivar_usuario_command(username):
+    """Desactiva USERNAME y revoca sus sesiones abiertas en todos los workers."""
+    cur = get_conn().cursor()
+    cur.execute("SELECT id FROM users WHERE username=? AND active=1", (username,))
+    u = cur.fetchone()
+    if not u:
+        raise click.ClickException(f"No existe el usuario activo {username}.")
+    deactivate_user(u["id"])
+    click.echo(f"{username} desactivado.")
+
+
+# -------------------------
+# Instrumentación (/metrics)
+# -------------------------
+# Métricas en memoria de cada proceso; con varios workers cada serie lleva su pid
+# en la etiqueta "worker" y se agregan en Prometheus con sum().
+METRICS_TOKEN = None   # /metrics pide "Authorization: Bearer <token>"; sin token está desactivado
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MAX_SQL = 500  # sentencias distintas con serie propia; el resto va a "otras"
+SLOW_QUERY_MS = 250    # umbral del log de consultas lentas (ms, ejecución + lectura de filas)
+
+_SQL_ESPACIOS = re.compile(r"\s+")
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LISTA = re.compile(r"\?(\s*,\s*\?)+")
+
+
+def normalizar_sql(sql):
+    """
+    Una línea, literales como ? y las listas IN (?, ?, ...) de largo variable como una
+    sola sentencia. Devuelve (huella, operación, sentencia normalizada): en /metrics solo
+    salen la huella y la operación; el texto, en el log de consultas lentas.
+    """
+    norm = _SQL_ESPACIOS.sub(" ", sql).strip()
+    norm = _SQL_LISTA.sub("?, ...", _SQL_LITERAL.sub("?", norm))
+    huella = hashlib.sha1(norm.encode("utf-8")).hexdigest()[:12]
+    return huella, (norm.split(" ", 1)[0].upper() or "?"), norm
+
+
+class _Histograma:
+    __slots__ = ("buckets", "suma", "n")
+
+    def __init__(self):
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.suma = 0.0
+        self.n = 0
+
+    def observar(self, segundos):
+        for i, limite in enumerate(METRICS_BUCKETS):
+            if segundos <= limite:
+                self.buckets[i] += 1
+        self.suma += segundos
+        self.n += 1
+
+
+class Metricas:
+    """Contadores e histogramas del proceso, con un lock (los workers son multihilo)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.peticiones = {}    # (endpoint, método, status) -> n
+        self.latencia = {}      # endpoint -> _Histograma
+        self.plantillas = {}    # plantilla -> _Histograma
+        self.sql = {}           # (huella, operación) -> [n, segundos]
+        self.sql_endpoint = {}  # endpoint -> [n, segundos]
+        self.sql_lentas = 0
+        self._sql_norm = {}     # texto crudo -> normalizar_sql()
+
+    def peticion(self, endpoint, metodo, status, segundos):
+        with self.lock:
+            clave = (endpoint, metodo, status)
+            self.peticiones[clave] = self.peticiones.get(clave, 0) + 1
+            self.latencia.setdefault(endpoint, _Histograma()).observar(segundos)
+
+    def plantilla(self, nombre, segundos):
+        with self.lock:
+            self.plantillas.setdefault(nombre, _Histograma()).observar(segundos)
+
+    def consulta(self, sql, endpoint, segundos):
+        info = self._sql_norm.get(sql)
+        if info is None:
+            info = normalizar_sql(sql)
+            if len(self._sql_norm) < METRICS_MAX_SQL * 4:
+                self._sql_norm[sql] = info
+        huella, op, norm = info
+        lenta = segundos * 1000 >= SLOW_QUERY_MS
+        with self.lock:
+            clave = (huella, op)
+            if clave not in self.sql and len(self.sql) >= METRICS_MAX_SQL:
+                clave = ("otras", op)
+            acum = self.sql.setdefault(clave, [0, 0.0])
+            acum[0] += 1
+            acum[1] += segundos
+            acum = self.sql_endpoint.setdefault(endpoint, [0, 0.0])
+            acum[0] += 1
+            acum[1] += segundos
+            if lenta:
+                self.sql_lentas += 1
+        if lenta:
+            app.logger.warning("consulta lenta %s: %.1f ms en %s: %s", huella, segundos * 1000, endpoint, norm)
+
+    def texto(self):
+        """Formato de exposición de texto de Prometheus (0.0.4)."""
+        worker = str(os.getpid())
+
+        def etiquetas(**kw):
+            pares = [("worker", worker)] + list(kw.items())
+            return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in pares) + "}"
+
+        def histograma(nombre, ayuda, etiqueta, series):
+            out.append(f"# HELP {nombre} {ayuda}")
+            out.append(f"# TYPE {nombre} histogram")
+            for valor, h in sorted(series.items()):
+                for limite, n in zip(METRICS_BUCKETS, h.buckets):
+                    out.append(f"{nombre}_bucket{etiquetas(**{etiqueta: valor, 'le': repr(limite)})} {n}")
+                out.append(f"{nombre}_bucket{etiquetas(**{etiqueta: valor, 'le': '+Inf'})} {h.n}")
+                out.append(f"{nombre}_sum{etiquetas(**{etiqueta: valor})} {h.suma:.6f}")
+                out.append(f"{nombre}_count{etiquetas(**{etiqueta: valor})} {h.n}")
+
+        def contador(nombre, ayuda, filas):
+            out.append(f"# HELP {nombre} {ayuda}")
+            out.append(f"# TYPE {nombre} counter")
+            for kw, valor in filas:
+                out.append(f"{nombre}{etiquetas(**kw)} {valor}")
+
+        out = []
+        with self.lock:
+            contador("t360_requests_total", "Peticiones HTTP atendidas.", [
+                (dict(endpoint=e, method=m, status=str(s)), n)
+                for (e, m, s), n in sorted(self.peticiones.items())
+            ])
+            histograma("t360_request_duration_seconds", "Latencia de las peticiones por endpoint.",
+                       "endpoint", self.latencia)
+            histograma("t360_template_render_seconds", "Tiempo de render por plantilla.",
+                       "template", self.plantillas)
+            contador("t360_sql_queries_total", "Sentencias SQL ejecutadas por endpoint.", [
+                (dict(endpoint=e), v[0]) for e, v in sorted(self.sql_endpoint.items())
+            ])
+            contador("t360_sql_seconds_total", "Tiempo en SQL por endpoint (ejecución + lectura).", [
+                (dict(endpoint=e), f"{v[1]:.6f}") for e, v in sorted(self.sql_endpoint.items())
+            ])
+            contador("t360_sql_statement_total", "Ejecuciones por sentencia (huella de normalizar_sql).", [
+                (dict(stmt=h, op=op), v[0]) for (h, op), v in sorted(self.sql.items())
+            ])
+            contador("t360_sql_statement_seconds_total", "Tiempo por sentencia.", [
+                (dict(stmt=h, op=op), f"{v[1]:.6f}") for (h, op), v in sorted(self.sql.items())
+            ])
+            contador("t360_sql_slow_total", f"Sentencias de más de {SLOW_QUERY_MS} ms.", [
+                ({}, self.sql_lentas)
+            ])
+        return "\n".join(out) + "\n"
+
+
+def _prom_escape(valor):
+    return str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+metricas = Metricas()
+
+
+def _endpoint_actual():
+    if not has_request_context():
+        return "cli"
+    return request.endpoint or "sin_ruta"
+
+
+class TracingCursor:
+    """
+    Cursor que mide cada sentencia: ejecución más la lectura de sus filas, porque en
+    SQLite buena parte del trabajo de un SELECT ocurre al ir pidiendo filas. La medida
+    se cierra al agotar las filas, al ejecutar otra sentencia o al acabar el request.
+    """
+
+    def __init__(self, cur, conn):
+        self._cur = cur
+        self._conn = conn
+        self._sql = None
+        self._endpoint = None
+        self._dur = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def _medir(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._dur += time.perf_counter() - t0
+
+    def cerrar_medida(self):
+        if self._sql is not None:
+            metricas.consulta(self._sql, self._endpoint, self._dur)
+            self._sql = None
+            self._conn.abiertos.discard(self)
+
+    def execute(self, sql, params=()):
+        self.cerrar_medida()
+        # el endpoint se fija aquí: en respuestas en streaming la medida puede cerrarse sin request
+        self._sql, self._endpoint, self._dur = sql, _endpoint_actual(), 0.0
+        self._conn.abiertos.add(self)
+        self._medir(self._cur.execute, sql, params)
+        return self
+
+    def executemany(self, sql, seq):
+        self.cerrar_medida()
+        self._sql, self._endpoint, self._dur = sql, _endpoint_actual(), 0.0
+        self._medir(self._cur.executemany, sql, seq)
+        self.cerrar_medida()
+        return self
+
+    def fetchone(self):
+        row = self._medir(self._cur.fetchone)
+        if row is None:
+            self.cerrar_medida()
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._medir(self._cur.fetchmany, size or self._cur.arraysize)
+        if not rows:
+            self.cerrar_medida()
+        return rows
+
+    def fetchall(self):
+        rows = self._medir(self._cur.fetchall)
+        self.cerrar_medida()
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self.cerrar_medida()
+        self._cur.close()
+
+
+class TracingConnection:
+    """Envoltorio de la conexión del pool que devuelve get_conn(): cursores medidos."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.abiertos = set()  # cursores con una medida sin cerrar
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def cursor(self):
+        return TracingCursor(self.raw.cursor(), self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def cerrar_medidas(self):
+        for cur in list(self.abiertos):
+            cur.cerrar_medida()
+
+
+@app.before_request
+def _medir_inicio():
+    g.t_inicio = time.perf_counter()
+
+
+@app.after_request
+def _medir_fin(resp):
+    if "t_inicio" not in g:
+        return resp
+    t0 = g.pop("t_inicio")
+    endpoint, metodo, status = _endpoint_actual(), request.method, resp.status_code
+    if resp.is_streamed:
+        # el cuerpo (p. ej. un export con stream_with_context) se genera al enviarlo: sus
+        # consultas las cierra release_conn al terminar y la duración se mide al cerrar
+        resp.call_on_close(lambda: metricas.peticion(endpoint, metodo, status, time.perf_counter() - t0))
+        return resp
+    # el teardown de la conexión llega después: las medidas pendientes se cierran aquí
+    if "db" in g:
+        g.db.cerrar_medidas()
+    metricas.peticion(endpoint, metodo, status, time.perf_counter() - t0)
+    return resp
+
+
+@app.teardown_request
+def _medir_error(exc):
+    # excepción no capturada: after_request no corre
+    if exc is not None and "t_inicio" in g:
+        metricas.peticion(_endpoint_actual(), request.method, 500, time.perf_counter() - g.pop("t_inicio"))
+
+
+@before_render_template.connect_via(app)
+def _plantilla_inicio(sender, template, context, **extra):
+    g.setdefault("t_plantillas", []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def _plantilla_fin(sender, template, context, **extra):
+    pila = g.get("t_plantillas")
+    if pila:
+        metricas.plantilla(template.name or "?", time.perf_counter() - pila.pop())
+
+
+@app.route("/metrics")
+def metrics():
+    # sin confiar en remote_addr: detrás de un proxy local todas las peticiones son de 127.0.0.1
+    if not METRICS_TOKEN:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    return Response(metricas.texto(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# -------------------------
+# Servidor de producción
+# -------------------------
+# Constantes que se pueden fijar con create_app(config) o con variables T360_<NOMBRE>
+def _cfg_ruta(value):
+    value = str(value).strip()
+    if not value:
+        raise ValueError("no puede estar vacío")
+    return value
+
+
+def _cfg_opcional(value):
+    return (str(value).strip() or None) if value is not None else None
+
+
+def _cfg_opcion(*opciones):
+    def parse(value):
+        value = _cfg_opcional(value)
+        if value is not None and value not in opciones:
+            raise ValueError(f"debe ser uno de {', '.join(opciones)} o vacío")
+        return value
+    return parse
+
+
+def _cfg_ms(value):
+    value = float(value)
+    if value <= 0:
+        raise ValueError("debe ser mayor que 0")
+    return value
+
+
+# constante -> parser; se aplican con create_app(config) o con variables T360_<NOMBRE>
+CONFIG_KEYS = {
+    "DB_PATH": _cfg_ruta,
+    "EMPRESAS_MODO": _cfg_opcion("subdominio", "usuario"),
+    "EMPRESAS_DOMINIO": _cfg_opcional,
+    "EMPRESAS_DIR": _cfg_ruta,
+    "SESSION_DB": _cfg_opcional,
+    "LOGIN_LIMITER_DB": _cfg_opcional,
+    "UPLOAD_ROOT": _cfg_ruta,
+    "UPLOAD_SENDFILE": _cfg_opcion("x-accel", "x-sendfile"),
+    "METRICS_TOKEN": _cfg_opcional,
+    "SLOW_QUERY_MS": _cfg_ms,
+}
+SERVE_THREADS = 4            # hilos por worker
+SERVE_GRACEFUL_TIMEOUT = 30  # segundos para terminar requests en curso al recargar/parar
+
+
+def create_app(config=None):
+    """
+    Punto de entrada WSGI (gunicorn "app:create_app()"). No es una factoría: las rutas
+    están declaradas sobre el `app` del módulo, que es único por proceso; create_app
+    configura ese singleton y lo devuelve, así que dos llamadas comparten app y estado
+    y manda la última configuración. Para dos configuraciones a la vez, dos procesos.
+    Aplica T360_<NOMBRE> y luego config, convertidos y validados con su parser de
+    CONFIG_KEYS, sobre esas constantes; ValueError si algún valor no es válido. Si algo
+    cambia, cierra los pools y vacía las cachés abiertos con la configuración anterior.
+    No migra: eso lo hace serve/migrar antes de arrancar workers; si no, la primera
+    conexión de cada empresa lo comprueba igualmente con init_db.
+    """
+    global _login_limiter
+    valores = {k: os.environ[f"T360_{k}"] for k in CONFIG_KEYS if f"T360_{k}" in os.environ}
+    valores.update(config or {})
+    parsed = {}
+    for key, value in valores.items():
+        if key not in CONFIG_KEYS:
+            raise KeyError(f"Configuración desconocida: {key}")
+        try:
+            parsed[key] = CONFIG_KEYS[key](value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Configuración {key}={value!r} no válida: {e}") from None
+    # todo o nada: no se aplica nada si algún valor no es válido
+    cambios = {k for k, v in parsed.items() if globals()[k] != v}
+    globals().update(parsed)
+    if cambios:
+        empresa_pools.close_all()
+        _login_limiter = None
+        _settings_caches.clear()
+        render_cache.clear()
+    app.session_interface = (
+        SqliteSessionInterface(lambda: SESSION_DB) if SESSION_DB else SecureCookieSessionInterface()
     )
+    return app
+
+
+def migrar_todo(log=None):
+    """Migra la BD principal y todas las de EMPRESAS_DIR, una vez y en el proceso maestro."""
+    empresas = [None]
+    if EMPRESAS_MODO and os.path.isdir(EMPRESAS_DIR):
+        empresas += sorted(f[:-3] for f in os.listdir(EMPRESAS_DIR) if f.endswith(".db") and _EMPRESA_RE.match(f[:-3]))
+    for empresa in empresas:
+        pool = ConnectionPool(empresa_db_path(empresa), size=1)
+        conn = pool.acquire()
+        try:
+            aplicadas = migrate(conn, log=log)
+            if log and aplicadas:
+                log(f"{empresa or DB_PATH}: {len(aplicadas)} migraciones")
+        finally:
+            pool.release(conn)
+            pool.close_all()
+
+
+def _despues_de_fork():
+    """En cada worker: nada de conexiones SQLite ni hilos heredados del maestro."""
+    global empresa_pools, _upload_executor, _login_limiter
+    empresa_pools = EmpresaPools()
+    _upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="uploads")
+    _login_limiter = None
+    _settings_caches.clear()
+    render_cache.clear()
+    metricas.reset()
+    if isinstance(app.session_interface, SqliteSessionInterface):
+        app.session_interface = SqliteSessionInterface(lambda: SESSION_DB)
+
+
+def _serve_gunicorn(gunicorn_base, bind, workers, threads):
+    """
+    Con gunicorn instalado: HUP recarga los workers de forma ordenada; para cambiar
+    de código sin cortar, USR2 (nuevo maestro) y luego WINCH/QUIT al viejo.
+    """
+    class T360Gunicorn(gunicorn_base.BaseApplication):
+        def load_config(self):
+            for key, value in {
+                "bind": bind,
+                "workers": workers,
+                "threads": threads,
+                "worker_class": "gthread",
+                "graceful_timeout": SERVE_GRACEFUL_TIMEOUT,
+                "on_starting": lambda server: migrar_todo(log=server.log.info),
+                "on_reload": lambda server: migrar_todo(log=server.log.info),
+                "post_fork": lambda server, worker: _despues_de_fork(),
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    T360Gunicorn().run()
+
+
+class _ServidorAcotado(ThreadedWSGIServer):
+    """Servidor werkzeug con hilos, pero como mucho `hilos` requests a la vez por worker:
+    si están todos ocupados deja de aceptar y las conexiones esperan en el backlog."""
+
+    def __init__(self, host, port, app, hilos, fd=None):
+        super().__init__(host, port, app, fd=fd)
+        self._cupo = threading.BoundedSemaphore(hilos)
+
+    def process_request(self, request, client_address):
+        self._cupo.acquire()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._cupo.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._cupo.release()
+
+
+def _serve_prefork(host, port, workers, threads):
+    """
+    Sin gunicorn (solo POSIX): el maestro abre el socket y hace fork de N workers
+    werkzeug que lo comparten. Si un worker muere se arranca otro. SIGHUP recarga con
+    el código nuevo: el maestro se re-ejecuta conservando el socket, migra, arranca
+    workers nuevos y después pide a los viejos que terminen lo que tengan en curso.
+    SIGTERM/SIGINT paran todo.
+    """
+    fd = os.environ.pop("T360_LISTEN_FD", None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+    sock.set_inheritable(True)
+    viejos = [int(p) for p in os.environ.pop("T360_OLD_WORKERS", "").split(",") if p]
+
+    def arrancar_worker():
+        pid = os.fork()
+        if pid:
+            return pid
+        for sig in (signal.SIGHUP, signal.SIGINT):
+            signal.signal(sig, signal.SIG_IGN)
+        _despues_de_fork()
+        if threads > 1:
+            srv = _ServidorAcotado(host, port, app, threads, fd=sock.fileno())
+        else:
+            srv = make_server(host, port, app, fd=sock.fileno())
+        # hilos de request no daemon: server_close() los espera antes de salir
+        srv.daemon_threads = False
+
+        def parar(*_):
+            # shutdown() espera a serve_forever: se lanza desde otro hilo; si las requests
+            # en curso no acaban en SERVE_GRACEFUL_TIMEOUT, se sale igualmente
+            threading.Thread(target=srv.shutdown).start()
+            limite = threading.Timer(SERVE_GRACEFUL_TIMEOUT, os._exit, (1,))
+            limite.daemon = True
+            limite.start()
+
+        signal.signal(signal.SIGTERM, parar)
+        srv.serve_forever()
+        srv.server_close()
+        os._exit(0)
+
+    migrar_todo(log=click.echo)
+    hijos = {arrancar_worker() for _ in range(workers)}
+    click.echo(f"t360: {workers} workers en {host}:{port} (maestro {os.getpid()})")
+    for pid in viejos:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    estado = {"parar": False, "recargar": False}
+    signal.signal(signal.SIGTERM, lambda *_: estado.update(parar=True))
+    signal.signal(signal.SIGINT, lambda *_: estado.update(parar=True))
+    signal.signal(signal.SIGHUP, lambda *_: estado.update(recargar=True))
+
+    while not estado["parar"]:
+        if estado["recargar"]:
+            os.environ["T360_LISTEN_FD"] = str(sock.fileno())
+            os.environ["T360_OLD_WORKERS"] = ",".join(str(p) for p in hijos)
+            # orig_argv conserva "-m flask"; argv[0] sería la ruta de flask/__main__.py
+            argv = getattr(sys, "orig_argv", [sys.executable] + sys.argv)
+            os.execv(sys.executable, [sys.executable] + argv[1:])
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid in hijos:
+            hijos.discard(pid)
+            hijos.add(arrancar_worker())
+        elif not pid:
+            time.sleep(0.5)
+
+    for pid in hijos:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    limite = time.time() + SERVE_GRACEFUL_TIMEOUT
+    while hijos and time.time() < limite:
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        hijos.discard(pid)
+        if not pid:
+            time.sleep(0.1)
+    for pid in hijos:
+        os.kill(pid, signal.SIGKILL)
+
+
+@app.cli.command("serve")
+@click.option("--bind", default="127.0.0.1:8000", show_default=True, help="host:puerto")
+@click.option("--workers", type=int, default=None, help="Procesos (por defecto, uno por núcleo).")
+@click.option("--threads", type=int, default=SERVE_THREADS, show_default=True, help="Hilos por proceso.")
+def serve_command(bind, workers, threads):
+    """Servidor de producción: migra una vez y arranca N workers (gunicorn si está instalado)."""
+    try:
+        create_app()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    workers = workers or os.cpu_count() or 1
+    try:
+        import gunicorn.app.base as gunicorn_base
+    except ImportError:
+        gunicorn_base = None
+    if gunicorn_base is not None:
+        _serve_gunicorn(gunicorn_base, bind, workers, threads)
+    else:
+        host, _, port = bind.rpartition(":")
+        _serve_prefork(host or "127.0.0.1", int(port), workers, threads)
 
 
 if __name__ == "__main__":
-    init_db()
+    with app.app_context():
+        init_db()
     app.run(host="127.0.0.1", port=5000, debug=True)
 
 